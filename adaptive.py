@@ -0,0 +1,160 @@
+import time
+import threading
+
+import numpy as np
+
+from pyramid import Pyramid
+
+# Adaptive MJPEG encoding. Servers report the age of every frame as they
+# finish sending it, the encoder reports the CPU time it spends, and twice a
+# second the controller steps JPEG quality, then frame rate, then resolution
+# down while frames arrive later than the target (or the encoder uses more
+# than its CPU share), and back up in the opposite order after a few seconds
+# of headroom, so a congested link sees a smaller, sparser stream rather than
+# seconds of queued stale video.
+
+class AdaptiveController:
+    def __init__(self, target=0.25, quality=(30, 85), fps=(2.0, 30.0), levels=2, cpu=0.5,
+                 period=0.5, qstep=10, fpsfactor=0.7, patience=6):
+        self.target = target
+        self.qmin, self.qmax = quality
+        self.fpsmin, self.fpsmax = fps
+        self.levels = levels
+        self.cpu = cpu
+        self.period = period
+        self.qstep = qstep
+        self.fpsfactor = fpsfactor
+        # Updates in a row with headroom before stepping back up, so one
+        # quiet period doesn't undo a step straight away
+        self.patience = patience
+        self.good = 0
+        self.quality = self.qmax
+        self.fps = self.fpsmax
+        self.level = 0
+        # Ages of frames sent since the last update, in a fixed ring
+        self.ages = np.zeros(1024)
+        self.nages = 0
+        self.lastsend = None
+        self.encodecpu = 0.0
+        self.lock = threading.Lock()
+        self.lastupdate = time.monotonic()
+        self.due = 0.0
+        self.latency = 0.0
+        self.load = 0.0
+
+    def record_send(self, age):
+        with self.lock:
+            self.ages[self.nages % len(self.ages)] = age
+            self.nages += 1
+            self.lastsend = time.monotonic()
+
+    def record_encode(self, seconds):
+        with self.lock:
+            self.encodecpu += seconds
+
+    def frame_due(self, now):
+        # Paces frames at the current rate, without trying to catch up on
+        # ones that were skipped
+        if now < self.due:
+            return False
+        self.due = max(self.due + 1 / self.fps, now)
+        return True
+
+    def update(self, now):
+        elapsed = now - self.lastupdate
+        if elapsed < self.period:
+            return
+        with self.lock:
+            n = min(self.nages, len(self.ages))
+            if n:
+                self.latency = float(np.percentile(self.ages[:n], 90))
+            elif self.lastsend is not None:
+                # Nothing finished sending, a send blocked for longer than a
+                # frame interval is at least that late
+                self.latency = max(0.0, now - self.lastsend - 1 / self.fps)
+            self.load = self.encodecpu / elapsed
+            self.nages = 0
+            self.encodecpu = 0.0
+        self.lastupdate = now
+        if self.latency > self.target or self.load > self.cpu:
+            self.good = 0
+            self.step_down()
+        elif n and self.latency < self.target / 2 and self.load < self.cpu / 2:
+            self.good += 1
+            if self.good >= self.patience:
+                self.good = 0
+                self.step_up()
+        else:
+            self.good = 0
+
+    def step_down(self):
+        if self.quality > self.qmin:
+            self.quality = max(self.qmin, self.quality - self.qstep)
+        elif self.fps > self.fpsmin:
+            self.fps = max(self.fpsmin, self.fps * self.fpsfactor)
+        elif self.level < self.levels:
+            self.level += 1
+
+    def step_up(self):
+        if self.level > 0:
+            self.level -= 1
+        elif self.fps < self.fpsmax:
+            self.fps = min(self.fpsmax, self.fps / self.fpsfactor)
+        elif self.quality < self.qmax:
+            self.quality = min(self.qmax, self.quality + self.qstep)
+
+    def state(self):
+        return {"quality": self.quality, "fps": self.fps, "level": self.level,
+                "latency": self.latency, "load": self.load}
+
+    def add_metrics(self, registry, labels=None):
+        registry.gauge("adaptive_quality", "JPEG quality chosen by the adaptive controller", labels, lambda: self.quality)
+        registry.gauge("adaptive_fps", "Frame rate chosen by the adaptive controller", labels, lambda: self.fps)
+        registry.gauge("adaptive_level", "Halvings of the stream resolution", labels, lambda: self.level)
+        registry.gauge("adaptive_latency_seconds", "90th percentile age of frames as they were sent", labels, lambda: self.latency)
+        registry.gauge("adaptive_encode_load", "Fraction of a core spent encoding", labels, lambda: self.load)
+
+
+class AdaptiveStream:
+    # Encodes frames for one FrameBroadcast under a controller. secure()
+    # copies (and downscales) a frame out of the request on the capture
+    # thread, encode() runs after the request has been released. format is
+    # the stream's pixel format, YUV420 or one of the 32 bit RGB formats.
+    def __init__(self, output, controller, format):
+        self.output = output
+        self.controller = controller
+        self.pyramid = Pyramid(format)
+        self.planes = None
+        output.add_send_listener(controller.record_send)
+
+    def wanted(self, now):
+        if not self.output.has_subscribers():
+            return False
+        self.controller.update(now)
+        return self.controller.frame_due(now)
+
+    def secure(self, array):
+        level = self.controller.level
+        self.planes = self.pyramid.build(array, {level})[level]
+
+    def encode(self):
+        start = time.thread_time()
+        jpeg = self.pyramid.encode(self.planes, int(self.controller.quality))
+        self.controller.record_encode(time.thread_time() - start)
+        self.output.write(jpeg)
+
+def add_adaptive_arguments(parser):
+    parser.add_argument('--adaptive', default=False, action='store_true', help='Software encode the stream, adapting quality, frame rate and resolution to keep frames under --targetlatency old when sent')
+    parser.add_argument('--targetlatency', type=float, default=0.25, help='Target age (s) of frames as they are sent to clients')
+    parser.add_argument('--quality', type=int, nargs=2, default=[30, 85], help='Adaptive JPEG quality range')
+    parser.add_argument('--fpsrange', type=float, nargs=2, default=[2.0, 30.0], help='Adaptive frame rate range')
+    parser.add_argument('--maxhalvings', type=int, default=2, help='Times the adaptive stream may halve its resolution')
+    parser.add_argument('--encodecpu', type=float, default=0.5, help='Fraction of a core the adaptive encoder may use')
+    parser.add_argument('--sndbuf', type=int, default=65536, help='Socket send buffer for adaptive streams, larger hides more of a slow client\'s lag from the controller')
+
+def sndbuf_from_args(args):
+    return args.sndbuf if args.adaptive else None
+
+def controller_from_args(args):
+    return AdaptiveController(target=args.targetlatency, quality=tuple(args.quality), fps=tuple(args.fpsrange),
+                              levels=args.maxhalvings, cpu=args.encodecpu)
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+from http import server
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from broadcast import FrameBroadcast
+
+# Per viewer CPU cost of the old per-client multipart framing (boundary,
+# send_header/end_headers and three writes per frame) against sending the
+# part prebuilt once by the producer, with N simulated clients on socketpairs.
+
+def drain(sock):
+    try:
+        while sock.recv(1 << 20):
+            pass
+    except OSError:
+        pass
+
+def old_sender(sock, output, frames, cpu):
+    # Same calls the handlers used to make for every frame
+    h = server.BaseHTTPRequestHandler.__new__(server.BaseHTTPRequestHandler)
+    h.wfile = sock.makefile('wb', buffering=0)
+    h.request_version = 'HTTP/1.0'
+    start = time.thread_time()
+    with output.subscribe() as sub:
+        for i in range(frames):
+            seq, frame, stamp = sub.get()
+            h.wfile.write(b'--FRAME\r\n')
+            h.send_header('Content-Type', 'image/jpeg')
+            h.send_header('Content-Length', len(frame))
+            h.end_headers()
+            h.wfile.write(frame)
+            h.wfile.write(b'\r\n')
+    cpu.append(time.thread_time() - start)
+
+def new_sender(sock, output, frames, cpu):
+    wfile = sock.makefile('wb', buffering=0)
+    start = time.thread_time()
+    with output.subscribe() as sub:
+        for i in range(frames):
+            seq, part, stamp = sub.get()
+            wfile.write(part)
+    cpu.append(time.thread_time() - start)
+
+def run(mode, clients, frames, framesize, fps):
+    if mode == "old":
+        output, sender = FrameBroadcast(size=frames + 1, framing=None), old_sender
+    else:
+        output, sender = FrameBroadcast(size=frames + 1), new_sender
+    frame = os.urandom(framesize)
+    cpu = []
+    threads = []
+    for i in range(clients):
+        a, b = socket.socketpair()
+        threads.append(threading.Thread(target=sender, args=(a, output, frames, cpu)))
+        threading.Thread(target=drain, args=(b,), daemon=True).start()
+    for t in threads:
+        t.start()
+    produce = time.thread_time()
+    for i in range(frames):
+        output.write(frame)
+        time.sleep(1 / fps)
+    produce = time.thread_time() - produce
+    for t in threads:
+        t.join()
+    return {"mode": mode,
+            "clients": clients,
+            "frames": frames,
+            "framesize": framesize,
+            "producer_us_per_frame": produce / frames * 1e6,
+            "viewer_us_per_frame": sum(cpu) / len(cpu) / frames * 1e6}
+
+def main():
+    parser = argparse.ArgumentParser(description='MJPEG multipart framing benchmark', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 10, 50], help='Simulated viewer counts')
+    parser.add_argument('--frames', type=int, default=200, help='Frames per run')
+    parser.add_argument('--framesize', type=int, default=100000, help='JPEG size in bytes')
+    parser.add_argument('--fps', type=float, default=100, help='Producer frame rate')
+    args = parser.parse_args()
+
+    results = []
+    for clients in args.clients:
+        for mode in ("old", "new"):
+            results.append(run(mode, clients, args.frames, args.framesize, args.fps))
+            print(json.dumps(results[-1]), flush=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+#!/usr/bin/python3
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import socket
+import platform
+import resource
+import tempfile
+import argparse
+import datetime
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import simplejpeg
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from framesource import SyntheticFrames
+from overlay import Overlay
+from exif_writer import exif_template, write_jpeg
+from metadata_log import MetadataLog
+from broadcast import FrameBroadcast, LATEST
+from streaming import AsyncStreamingServer, StreamingServer, make_handler
+import stack
+
+# End to end benchmarks on fixed synthetic frames. Each case runs in a fresh
+# process so its peak RSS is its own, and prints one JSON line, --output
+# saves the whole run and --compare prints the change from a saved one.
+#
+#   timelapse  capture copy, overlay, JPEG encode, EXIF, write + metadata log
+#   crops      framing-focus-tool crop copy and encode on a thread pool
+#   stack      JPEG decode and Stacker.add for every mode
+#   stream     MJPEG server fan-out to K clients, latency from frame written
+#              to the last byte of it arriving at a client
+
+SUITES = ("timelapse", "crops", "stack", "stream")
+
+def percentiles(ns):
+    ms = np.asarray(ns, np.float64) / 1e6
+    if ms.size == 0:
+        return {}
+    p50, p90, p99 = np.percentile(ms, (50, 90, 99))
+    return {"p50_ms": p50, "p90_ms": p90, "p99_ms": p99, "max_ms": float(ms.max())}
+
+class Stages:
+    # Durations in ns, preallocated per stage so timing allocates nothing
+    def __init__(self, names, n):
+        self.times = {name: np.zeros(n, np.int64) for name in names}
+
+    def report(self, n):
+        return {name: percentiles(t[:n]) for name, t in self.times.items()}
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def dir_bytes(dirname):
+    return sum(os.path.getsize(f) for f in glob.glob(os.path.join(dirname, "**"), recursive=True) if os.path.isfile(f))
+
+def frame_at(frames, size, n):
+    buf = np.empty((size[1], size[0], 4), np.uint8)
+    frames.fill(n, size, buf)
+    return buf
+
+
+def bench_timelapse(size, args, dirname):
+    frames = SyntheticFrames()
+    overlay = Overlay()
+    mdlog = MetadataLog()
+    template = exif_template("Raspberry Pi", "synthetic", "Picamera2")
+    buf = frame_at(frames, size, 0)
+    stages = Stages(("capture", "overlay", "encode", "exif", "write", "total"), args.frames)
+    t = stages.times
+    start = time.perf_counter()
+    for i in range(args.frames):
+        t0 = time.perf_counter_ns()
+        metadata = frames.next(i)
+        frames.fill(i, size, buf)
+        t1 = time.perf_counter_ns()
+        dt = datetime.datetime(2024, 1, 1) + datetime.timedelta(seconds=i)
+        overlay.apply(buf, dt, metadata)
+        t2 = time.perf_counter_ns()
+        jpeg = simplejpeg.encode_jpeg(buf, quality=90, colorspace="RGBX", colorsubsampling="420")
+        t3 = time.perf_counter_ns()
+        app1 = template.app1(dt, metadata["ExposureTime"], 100, json.dumps(metadata, sort_keys=True))
+        t4 = time.perf_counter_ns()
+        name = dt.strftime("%Y%m%dT%H%M%S.jpg")
+        write_jpeg(os.path.join(dirname, name), jpeg, app1)
+        mdlog.append(os.path.join(dirname, "metadata.jsonl"), name, metadata)
+        t5 = time.perf_counter_ns()
+        t["capture"][i], t["overlay"][i], t["encode"][i] = t1 - t0, t2 - t1, t3 - t2
+        t["exif"][i], t["write"][i], t["total"][i] = t4 - t3, t5 - t4, t5 - t0
+    mdlog.close()
+    elapsed = time.perf_counter() - start
+    return {"fps": args.frames / elapsed, "stages": stages.report(args.frames), "bytes_written": dir_bytes(dirname)}
+
+def bench_crops(size, args, dirname):
+    # The default framing-focus-tool layout, four corners and a centre strip,
+    # shrunk in the same proportions for frames smaller than its 800x600 page
+    w2, h2 = min(400, size[0] // 2), min(300, size[1] // 2)
+    strip = min(190, size[1] * 190 // 600)
+    rects = [(0, 0, w2, h2), (size[0] - w2, 0, w2, h2),
+             (size[0] // 2 - w2, size[1] // 2 - strip // 2, 2 * w2, strip),
+             (0, size[1] - h2, w2, h2), (size[0] - w2, size[1] - h2, w2, h2)]
+    bufs = [np.empty((h, w, 4), np.uint8) for x, y, w, h in rects]
+    frame = frame_at(SyntheticFrames(), size, 0)
+    stages = Stages(("copy", "encode"), args.frames)
+    pool = ThreadPoolExecutor(max_workers=args.threads)
+
+    def encode(buf):
+        return len(simplejpeg.encode_jpeg(buf, quality=65, colorspace="RGBX", colorsubsampling="420"))
+
+    written = 0
+    start = time.perf_counter()
+    for i in range(args.frames):
+        t0 = time.perf_counter_ns()
+        for (x, y, w, h), buf in zip(rects, bufs):
+            np.copyto(buf, frame[y:y + h, x:x + w])
+        t1 = time.perf_counter_ns()
+        written += sum(pool.map(encode, bufs))
+        t2 = time.perf_counter_ns()
+        stages.times["copy"][i], stages.times["encode"][i] = t1 - t0, t2 - t1
+    elapsed = time.perf_counter() - start
+    pool.shutdown()
+    return {"fps": args.frames / elapsed, "threads": args.threads, "crops": len(rects),
+            "stages": stages.report(args.frames), "bytes_encoded": written}
+
+def bench_stack(size, args, dirname):
+    frames = SyntheticFrames()
+    buf = np.empty((size[1], size[0], 4), np.uint8)
+    filenames = []
+    for i in range(args.stackframes):
+        frames.fill(i, size, buf)
+        filenames.append(os.path.join(dirname, "%04d.jpg" % i))
+        with open(filenames[-1], "wb") as f:
+            f.write(simplejpeg.encode_jpeg(buf, quality=90, colorspace="RGBX"))
+
+    n = len(filenames)
+    decode = np.zeros(n, np.int64)
+    start = time.perf_counter()
+    decoded = []
+    for i, filename in enumerate(filenames):
+        t0 = time.perf_counter_ns()
+        decoded.append(stack.load(filename))
+        decode[i] = time.perf_counter_ns() - t0
+    result = {"frames": n, "decode_fps": n / (time.perf_counter() - start), "decode": percentiles(decode), "modes": {}}
+    del decoded[1:]
+
+    for mode in stack.MODES:
+        add = np.zeros(n, np.int64)
+        start = time.perf_counter()
+        s = stack.Stacker(mode, decoded[0].shape, decoded[0].dtype)
+        for i, filename in enumerate(filenames):
+            d = stack.load(filename)
+            t0 = time.perf_counter_ns()
+            s.add(d)
+            add[i] = time.perf_counter_ns() - t0
+        s.result()
+        entry = {"fps": n / (time.perf_counter() - start), "add": percentiles(add)}
+        if args.jobs > 1:
+            start = time.perf_counter()
+            stack.parallel_stack(filenames, args.jobs, mode, 3.0)
+            entry["parallel_fps"] = n / (time.perf_counter() - start)
+            entry["jobs"] = args.jobs
+        result["modes"][mode] = entry
+    return result
+
+def stream_client(port, path, partsize, frames, written, latency, counts, index):
+    # Parts are a fixed size (same JPEG, sequence number appended after EOI)
+    # so each is read whole and its sequence number found at a fixed offset
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.sendall(b"GET %s HTTP/1.0\r\n\r\n" % path.encode())
+    f = sock.makefile("rb")
+    while f.readline() not in (b"\r\n", b""):
+        pass
+    part = bytearray(partsize)
+    view = memoryview(part)
+    received = 0
+    try:
+        while True:
+            if f.readinto(view) < partsize:
+                break
+            now = time.perf_counter_ns()
+            seq = int.from_bytes(part[-10:-2], "little")
+            if received < latency.shape[1]:
+                latency[index, received] = now - written[seq]
+            received += 1
+            if seq >= frames:
+                break
+    finally:
+        counts[index] = received
+        sock.close()
+
+def bench_stream(size, args, dirname):
+    frames = SyntheticFrames()
+    jpeg = simplejpeg.encode_jpeg(frame_at(frames, size, 0), quality=85, colorspace="RGBX", colorsubsampling="420")
+    output = FrameBroadcast(size=8)
+    streams = {"/stream.mjpg": output}
+    if args.server == "asyncio":
+        import asyncio
+        port = free_port()
+        srv = AsyncStreamingServer(("127.0.0.1", port), "", streams, LATEST, args.maxlag)
+        threading.Thread(target=lambda: asyncio.run(srv.serve_forever()), daemon=True).start()
+        time.sleep(0.5)
+    else:
+        handler = make_handler("", streams, LATEST, args.maxlag)
+        handler.log_message = lambda *a: None
+        httpd = StreamingServer(("127.0.0.1", 0), handler)
+        port = httpd.server_address[1]
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    partsize = len(output.framing(jpeg + bytes(8)))
+    total = args.frames + 1
+    written = np.zeros(total + 1, np.int64)
+    latency = np.zeros((args.clients, total), np.int64)
+    counts = np.zeros(args.clients, np.int64)
+    threads = [threading.Thread(target=stream_client, args=(port, "/stream.mjpg", partsize, args.frames, written, latency, counts, i))
+               for i in range(args.clients)]
+    for t in threads:
+        t.start()
+    while output.subscribers < args.clients:
+        time.sleep(0.01)
+
+    cpu = time.process_time()
+    start = time.perf_counter()
+    due = start
+    for seq in range(1, total + 1):
+        # Sequence numbers match the broadcast's own, which the client
+        # indexes written[] with
+        written[seq] = time.perf_counter_ns()
+        output.write(jpeg + seq.to_bytes(8, "little"))
+        due += 1 / args.fps
+        time.sleep(max(0, due - time.perf_counter()))
+    for t in threads:
+        t.join(timeout=10)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+
+    delivered = counts.astype(np.float64)
+    lat = np.concatenate([latency[i, :counts[i]] for i in range(args.clients)])
+    return {"server": args.server,
+            "target_fps": args.fps,
+            "jpeg_bytes": len(jpeg),
+            "delivered_fps_mean": float(delivered.mean() / elapsed),
+            "delivered_fps_min": float(delivered.min() / elapsed),
+            "throughput_mb_s": float(delivered.sum() * partsize / elapsed / 1e6),
+            "cpu_percent": 100 * cpu / elapsed,
+            "latency": percentiles(lat)}
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+BENCHES = {"timelapse": bench_timelapse, "crops": bench_crops, "stack": bench_stack, "stream": bench_stream}
+
+def run_case(suite, size, args):
+    dirname = tempfile.mkdtemp(prefix="bench-", dir=args.dirname)
+    try:
+        result = BENCHES[suite](size, args, dirname)
+    finally:
+        shutil.rmtree(dirname, ignore_errors=True)
+    result["peak_rss_kb"] = peak_rss_kb()
+    return result
+
+def case_process(queue, suite, size, args):
+    try:
+        queue.put(run_case(suite, size, args))
+    except Exception as e:
+        queue.put({"error": repr(e)})
+        raise
+
+
+def case_key(result):
+    return " ".join(str(result[k]) for k in ("suite", "resolution", "clients", "server") if k in result)
+
+def flatten(d, prefix=""):
+    out = {}
+    for k, v in d.items():
+        if isinstance(v, dict):
+            out.update(flatten(v, prefix + k + "."))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[prefix + k] = v
+    return out
+
+def compare(old, new):
+    old = {case_key(r): flatten(r) for r in old["results"]}
+    for r in new["results"]:
+        key = case_key(r)
+        if key not in old:
+            continue
+        print(key)
+        for name, value in flatten(r).items():
+            before = old[key].get(name)
+            if before:
+                print("  %-40s %12.3f -> %12.3f  %+6.1f%%" % (name, before, value, 100 * (value - before) / before))
+
+def parse_size(s):
+    w, h = s.lower().split("x")
+    return (int(w), int(h))
+
+def main():
+    parser = argparse.ArgumentParser(description='Timelapse, stacking and streaming benchmarks', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--suites', type=str, nargs='+', default=list(SUITES), choices=SUITES, help='Benchmarks to run')
+    parser.add_argument('--resolutions', type=str, nargs='+', default=["1332x990", "2028x1520", "4056x3040"], help='Frame sizes (HQ camera modes by default)')
+    parser.add_argument('--frames', type=int, default=50, help='Frames per timelapse/crops/stream case')
+    parser.add_argument('--stackframes', type=int, default=20, help='Frames per stack case')
+    parser.add_argument('--jobs', type=int, default=1, help='Also time stack.py --jobs with this many processes')
+    parser.add_argument('--threads', type=int, default=os.cpu_count(), help='Crop encode threads')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 10, 50], help='Simulated stream viewer counts')
+    parser.add_argument('--fps', type=float, default=30, help='Stream producer frame rate')
+    parser.add_argument('--maxlag', type=int, default=2, help='Stream client lag before skipping frames')
+    parser.add_argument('--server', type=str, default="threading", choices=("threading", "asyncio"), help='Stream server')
+    parser.add_argument('--dirname', type=str, default=None, help='Where to write files (default the system temp directory)')
+    parser.add_argument('--output', type=str, default=None, help='Save the results as JSON')
+    parser.add_argument('--compare', type=str, default=None, help='Print changes against a saved --output')
+    args = parser.parse_args()
+
+    run = {"time": datetime.datetime.utcnow().isoformat(),
+           "python": platform.python_version(),
+           "machine": platform.machine(),
+           "cpus": os.cpu_count(),
+           "results": []}
+
+    ctx = multiprocessing.get_context("spawn")
+    for suite in args.suites:
+        for resolution in args.resolutions:
+            size = parse_size(resolution)
+            for clients in (args.clients if suite == "stream" else [None]):
+                caseargs = argparse.Namespace(**vars(args))
+                if clients is not None:
+                    caseargs.clients = clients
+                queue = ctx.Queue()
+                p = ctx.Process(target=case_process, args=(queue, suite, size, caseargs))
+                p.start()
+                result = queue.get()
+                p.join()
+                result = dict(suite=suite, resolution=resolution, **({"clients": clients} if clients else {}), **result)
+                run["results"].append(result)
+                print(json.dumps(result), flush=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(run, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), run)
+
+if __name__ == "__main__":
+    main()
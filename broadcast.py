@@ -0,0 +1,144 @@
+import io
+import time
+from threading import Condition
+
+# One producer, many readers frame fan-out. Frames go into a small ring
+# buffer tagged with a sequence number and each reader keeps its own cursor,
+# so a reader never sends the same frame twice and a slow one can be caught
+# up (or dropped) without affecting the others.
+
+LATEST = "latest"
+DISCONNECT = "disconnect"
+POLICIES = (LATEST, DISCONNECT)
+
+class Lagged(Exception):
+    pass
+
+BOUNDARY = b"FRAME"
+CONTENT_TYPE = "multipart/x-mixed-replace; boundary=" + BOUNDARY.decode()
+
+def multipart_part(frame, content_type=b"image/jpeg"):
+    # Complete part, boundary, headers, payload and trailing CRLF, built once
+    # per frame so every client sends it with a single write
+    header = b"--%s\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n" % (BOUNDARY, content_type, len(frame))
+    return b"".join((header, frame, b"\r\n"))
+
+def sse_event(data):
+    # Server-sent event carrying one line of data (e.g. JSON)
+    return b"data: %s\n\n" % data
+
+SSE_CONTENT_TYPE = "text/event-stream"
+
+class FrameBroadcast(io.BufferedIOBase):
+    # Frames written are stored as ready to send multipart parts (framing
+    # None stores them as written), content_type is what the HTTP response
+    # streaming them should declare
+    def __init__(self, size=8, framing=multipart_part, content_type=CONTENT_TYPE):
+        self.size = size
+        self.framing = framing
+        self.content_type = content_type
+        self.ring = [None] * size
+        self.stamps = [0.0] * size
+        self.seq = 0
+        self.subscribers = 0
+        # Totals over all subscribers, for metrics
+        self.sent = 0
+        self.skipped = 0
+        self.listeners = []
+        self.send_listeners = []
+        self.condition = Condition()
+
+    def writable(self):
+        return True
+
+    def write(self, buf):
+        n = len(buf)
+        if self.framing is not None:
+            buf = self.framing(buf)
+        with self.condition:
+            self.seq += 1
+            self.ring[self.seq % self.size] = buf
+            self.stamps[self.seq % self.size] = time.monotonic()
+            self.condition.notify_all()
+        for listener in self.listeners:
+            listener()
+        return n
+
+    def add_listener(self, listener):
+        # Called from the producer thread after every frame, for readers that
+        # cannot block on the condition (e.g. an asyncio loop)
+        self.listeners = self.listeners + [listener]
+
+    def remove_listener(self, listener):
+        self.listeners = [l for l in self.listeners if l is not listener]
+
+    def add_send_listener(self, listener):
+        # Called with a frame's age (s) each time a server finishes sending
+        # it to a client, e.g. for an adaptive encoder
+        self.send_listeners = self.send_listeners + [listener]
+
+    def record_send(self, stamp):
+        # Servers call this after each part is sent, with the stamp get()
+        # returned alongside it. The ring slot may well have been reused by
+        # then, a slow send is exactly when the producer has moved on.
+        if self.send_listeners:
+            age = time.monotonic() - stamp
+            for listener in self.send_listeners:
+                listener(age)
+
+    def latest(self):
+        with self.condition:
+            return self.seq, self.ring[self.seq % self.size]
+
+    def has_subscribers(self):
+        return self.subscribers > 0
+
+    def subscribe(self, policy=LATEST, maxlag=None):
+        return Subscription(self, policy, maxlag)
+
+
+class Subscription:
+    # maxlag is how many frames a reader may fall behind the producer before
+    # the policy applies, LATEST skips forward to the newest frame and
+    # DISCONNECT raises Lagged. It can be at most the ring size.
+    def __init__(self, broadcast, policy=LATEST, maxlag=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown lag policy %s" % policy)
+        self.broadcast = broadcast
+        self.policy = policy
+        self.maxlag = broadcast.size if maxlag is None else min(maxlag, broadcast.size)
+        with broadcast.condition:
+            self.cursor = broadcast.seq
+            broadcast.subscribers += 1
+        self.skipped = 0
+        self.closed = False
+
+    def get(self, timeout=None):
+        # Returns (seq, frame, stamp) for the next frame, stamp being when
+        # it was written (time.monotonic), or None on timeout
+        b = self.broadcast
+        with b.condition:
+            if not b.condition.wait_for(lambda: b.seq > self.cursor, timeout):
+                return None
+            behind = b.seq - self.cursor
+            if behind > self.maxlag:
+                if self.policy == DISCONNECT:
+                    raise Lagged("%d frames behind" % behind)
+                self.skipped += behind - 1
+                b.skipped += behind - 1
+                self.cursor = b.seq - 1
+            self.cursor += 1
+            b.sent += 1
+            return self.cursor, b.ring[self.cursor % b.size], b.stamps[self.cursor % b.size]
+
+    def close(self):
+        if not self.closed:
+            with self.broadcast.condition:
+                self.broadcast.subscribers -= 1
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
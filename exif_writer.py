@@ -0,0 +1,116 @@
+import os
+import struct
+import functools
+
+# Minimal EXIF APP1 writer. The TIFF structure is laid out once per camera
+# and cached, each frame only patches the date, exposure and ISO in a copy of
+# the template and appends the UserComment, which is the last value so its
+# length never moves anything else.
+
+ASCII = 2
+SHORT = 3
+LONG = 4
+RATIONAL = 5
+UNDEFINED = 7
+
+ASCII_PREFIX = b"ASCII\x00\x00\x00"
+DATETIME_LEN = 20
+
+class ExifTemplate:
+    def __init__(self, make, model, software):
+        def asciiz(s):
+            b = s.encode("ascii", "replace") + b"\x00"
+            # Count includes the terminator, the data is padded to a word boundary
+            return b + b"\x00" * (len(b) % 2), len(b)
+
+        (make, make_count), (model, model_count), (software, software_count) = asciiz(make), asciiz(model), asciiz(software)
+
+        ifd0_offset = 8
+        ifd0_len = 2 + 5 * 12 + 4
+        data = ifd0_offset + ifd0_len
+        make_offset = data
+        model_offset = make_offset + len(make)
+        software_offset = model_offset + len(model)
+        datetime_offset = software_offset + len(software)
+        exif_offset = datetime_offset + DATETIME_LEN
+        exif_len = 2 + 4 * 12 + 4
+        exposure_offset = exif_offset + exif_len
+        original_offset = exposure_offset + 8
+        comment_offset = original_offset + DATETIME_LEN
+
+        t = bytearray(b"II*\x00")
+        t += struct.pack("<I", ifd0_offset)
+        t += struct.pack("<H", 5)
+        t += struct.pack("<HHII", 0x010F, ASCII, make_count, make_offset)
+        t += struct.pack("<HHII", 0x0110, ASCII, model_count, model_offset)
+        t += struct.pack("<HHII", 0x0131, ASCII, software_count, software_offset)
+        t += struct.pack("<HHII", 0x0132, ASCII, DATETIME_LEN, datetime_offset)
+        t += struct.pack("<HHII", 0x8769, LONG, 1, exif_offset)
+        t += struct.pack("<I", 0)
+        t += make + model + software
+        t += b"\x00" * DATETIME_LEN
+        t += struct.pack("<H", 4)
+        t += struct.pack("<HHII", 0x829A, RATIONAL, 1, exposure_offset)
+        self.iso_pos = len(t) + 8
+        t += struct.pack("<HHIHH", 0x8827, SHORT, 1, 0, 0)
+        t += struct.pack("<HHII", 0x9003, ASCII, DATETIME_LEN, original_offset)
+        self.comment_count_pos = len(t) + 4
+        t += struct.pack("<HHII", 0x9286, UNDEFINED, 0, comment_offset)
+        t += struct.pack("<I", 0)
+        t += b"\x00" * 8
+        t += b"\x00" * DATETIME_LEN
+
+        self.datetime_pos = datetime_offset
+        self.exposure_pos = exposure_offset
+        self.original_pos = original_offset
+        # APP1 marker, length and Exif identifier go in front of the TIFF data
+        self.template = bytes(b"\xff\xe1\x00\x00Exif\x00\x00" + t)
+        self.header_len = 10
+
+    def app1(self, dt, exposure, iso, comment=None):
+        datetime = dt.strftime("%Y:%m:%d %H:%M:%S").encode("ascii")[:DATETIME_LEN - 1] + b"\x00"
+        if comment is not None:
+            comment = ASCII_PREFIX + comment.encode("ascii", "replace")
+        else:
+            comment = b""
+        # Segment length is a 16 bit field, drop the comment rather than overflow
+        if len(self.template) + len(comment) - 2 > 0xffff:
+            comment = b""
+
+        seg = bytearray(self.template)
+        seg += comment
+        h = self.header_len
+        struct.pack_into(">H", seg, 2, len(seg) - 2)
+        seg[h + self.datetime_pos:h + self.datetime_pos + len(datetime)] = datetime
+        seg[h + self.original_pos:h + self.original_pos + len(datetime)] = datetime
+        struct.pack_into("<II", seg, h + self.exposure_pos, int(exposure), 1000000)
+        struct.pack_into("<H", seg, h + self.iso_pos, max(0, min(int(iso), 0xffff)))
+        struct.pack_into("<I", seg, h + self.comment_count_pos, len(comment))
+        return seg
+
+@functools.lru_cache(maxsize=8)
+def exif_template(make, model, software):
+    return ExifTemplate(make, model, software)
+
+def write_jpeg(path, jpeg, app1=None):
+    # Writes SOI + APP1 + the rest of the encoder output with one writev,
+    # slicing the encoded JPEG through a memoryview so it is never copied
+    jpeg = memoryview(jpeg)
+    if app1 is not None:
+        if jpeg[:2] != b"\xff\xd8":
+            raise ValueError("Not a JPEG, missing SOI marker")
+        parts = [jpeg[:2], memoryview(app1), jpeg[2:]]
+    else:
+        parts = [jpeg]
+
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        while parts:
+            n = os.writev(fd, parts)
+            while parts and n >= len(parts[0]):
+                n -= len(parts[0])
+                parts.pop(0)
+            if n:
+                parts[0] = parts[0][n:]
+    finally:
+        os.close(fd)
@@ -0,0 +1,76 @@
+import os
+import json
+import time
+import threading
+import importlib
+
+# Startup helpers for the capture scripts. After a watchdog restart every
+# second spent importing and probing the camera is a lost frame, so the
+# camera model and patched tuning are cached on disk, heavy modules are
+# imported in the background while the camera starts, and the time taken
+# is reported.
+
+IMPORTED = time.perf_counter()
+
+def since_start():
+    # Seconds since the process started, interpreter startup and imports
+    # included, from /proc where there is one
+    try:
+        with open("/proc/self/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.perf_counter() - IMPORTED
+
+def warm(modules):
+    # Imports modules on a background thread so their first use doesn't
+    # wait for them, missing ones are left for that first use to report
+    def run():
+        for name in modules:
+            try:
+                importlib.import_module(name)
+            except ImportError:
+                pass
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+class ProbeCache:
+    # JSON file of probe results, each keyed by everything that went into
+    # it. A missing or unreadable file is just an empty cache.
+    def __init__(self, filename):
+        self.filename = os.path.expanduser(filename)
+        self.entries = {}
+        self.dirty = False
+        try:
+            with open(self.filename) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def key(self, key):
+        return json.dumps(key, sort_keys=True)
+
+    def get(self, key):
+        return self.entries.get(self.key(key))
+
+    def put(self, key, value):
+        self.entries[self.key(key)] = value
+        self.dirty = True
+
+    def remove(self, key):
+        if self.entries.pop(self.key(key), None) is not None:
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        dirname = os.path.dirname(self.filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(self.filename + ".new", "w") as f:
+            json.dump(self.entries, f, sort_keys=True)
+        os.rename(self.filename + ".new", self.filename)
+        self.dirty = False
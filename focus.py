@@ -0,0 +1,76 @@
+import numpy as np
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+# Focus metrics for the framing/focus tool, computed on a downsampled luma
+# plane so a whole field of ROIs costs a few ms per refresh. OpenCV is used
+# for the filters when it is installed, otherwise plain NumPy.
+
+def luma(array, scale=2):
+    # array is RGBX/RGB pixel data. Takes every scale'th pixel of each row
+    # and column rather than averaging, which keeps the high frequencies
+    # the metrics are looking for
+    v = array[::scale, ::scale]
+    y = v[:, :, 0].astype(np.uint16) * 77
+    y += v[:, :, 1].astype(np.uint16) * 150
+    y += v[:, :, 2].astype(np.uint16) * 29
+    y >>= 8
+    return y.astype(np.uint8)
+
+def laplacian_variance(y):
+    if y.shape[0] < 3 or y.shape[1] < 3:
+        return 0.0
+    if cv2 is not None:
+        return float(cv2.Laplacian(y, cv2.CV_32F)[1:-1, 1:-1].var())
+    lap = y[1:-1, :-2] + y[1:-1, 2:] + y[:-2, 1:-1] + y[2:, 1:-1] - 4 * y[1:-1, 1:-1]
+    return float(lap.var())
+
+def tenengrad(y):
+    if y.shape[0] < 3 or y.shape[1] < 3:
+        return 0.0
+    if cv2 is not None:
+        gx = cv2.Sobel(y, cv2.CV_32F, 1, 0)[1:-1, 1:-1]
+        gy = cv2.Sobel(y, cv2.CV_32F, 0, 1)[1:-1, 1:-1]
+        return float(np.mean(gx * gx + gy * gy))
+    left = y[:-2, :-2] + 2 * y[1:-1, :-2] + y[2:, :-2]
+    right = y[:-2, 2:] + 2 * y[1:-1, 2:] + y[2:, 2:]
+    top = y[:-2, :-2] + 2 * y[:-2, 1:-1] + y[:-2, 2:]
+    bottom = y[2:, :-2] + 2 * y[2:, 1:-1] + y[2:, 2:]
+    gx = right - left
+    gy = bottom - top
+    return float(np.mean(gx * gx + gy * gy))
+
+def measure(y, rect, scale=2):
+    # rect is (x, y, w, h) in full resolution pixels
+    x0, y0, w, h = rect
+    sub = y[y0 // scale:(y0 + h) // scale, x0 // scale:(x0 + w) // scale].astype(np.float32)
+    return {"laplacian": laplacian_variance(sub), "tenengrad": tenengrad(sub)}
+
+def parse_roi(s, size):
+    # "x,y,w,h" in pixels, or as fractions of the frame if every value is <= 1
+    values = [float(v) for v in s.split(",")]
+    if len(values) != 4:
+        raise ValueError("ROI must be x,y,w,h: %s" % s)
+    if all(v <= 1 for v in values):
+        values = [values[0] * size[0], values[1] * size[1], values[2] * size[0], values[3] * size[1]]
+    return clip_roi([int(v) for v in values], size)
+
+def clip_roi(rect, size):
+    x, y, w, h = rect
+    x = max(0, min(x, size[0] - 1))
+    y = max(0, min(y, size[1] - 1))
+    return (x, y, max(1, min(w, size[0] - x)), max(1, min(h, size[1] - y)))
+
+def parse_grid(s, size):
+    # "NxM", N columns by M rows of cells covering the whole frame
+    cols, rows = [int(v) for v in s.lower().split("x")]
+    rects = []
+    for r in range(rows):
+        for c in range(cols):
+            x0, x1 = size[0] * c // cols, size[0] * (c + 1) // cols
+            y0, y1 = size[1] * r // rows, size[1] * (r + 1) // rows
+            rects.append((x0, y0, x1 - x0, y1 - y0))
+    return rects
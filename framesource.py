@@ -0,0 +1,485 @@
+import os
+import glob
+import time
+import threading
+import collections
+from types import SimpleNamespace
+
+import numpy as np
+
+# Frame sources for the capture scripts. camera_module() returns the
+# Picamera2, MappedArray, encoder, output and libcamera names a script uses,
+# either the real picamera2 ones or stand-ins that generate synthetic frames
+# or replay a timelapse.py archive with the same request/array/metadata
+# interface, so the scripts can be run and benchmarked off a Pi.
+
+SOURCES = ("picamera2", "synthetic", "replay:DIR")
+
+def add_source_arguments(parser):
+    parser.add_argument('--source', type=str, default="picamera2", help='Frame source, picamera2, synthetic, or replay:DIR to replay a timelapse archive')
+    parser.add_argument('--sourcefps', type=float, default=None, help='Frame rate for synthetic/replay sources, defaults to the configured frame duration')
+
+def camera_module(source="picamera2", fps=None):
+    if source == "picamera2":
+        import picamera2
+        import picamera2.encoders
+        import picamera2.outputs
+        import libcamera
+        return SimpleNamespace(Picamera2=picamera2.Picamera2,
+                               MappedArray=picamera2.MappedArray,
+                               MJPEGEncoder=picamera2.encoders.MJPEGEncoder,
+                               JpegEncoder=picamera2.encoders.JpegEncoder,
+                               LibavMjpegEncoder=getattr(picamera2.encoders, "LibavMjpegEncoder", None),
+                               H264Encoder=picamera2.encoders.H264Encoder,
+                               Quality=picamera2.encoders.Quality,
+                               FileOutput=picamera2.outputs.FileOutput,
+                               SplittableOutput=picamera2.outputs.SplittableOutput,
+                               controls=libcamera.controls,
+                               Transform=libcamera.Transform,
+                               real=True)
+
+    if source == "synthetic":
+        frames = SyntheticFrames()
+    elif source.startswith("replay:"):
+        frames = ReplayFrames(source[len("replay:"):])
+    else:
+        raise ValueError("Unknown frame source %s, expected one of %s" % (source, ", ".join(SOURCES)))
+
+    def camera(*args, **kwargs):
+        return FakeCamera(frames, fps, **kwargs)
+
+    return SimpleNamespace(Picamera2=camera,
+                           MappedArray=MappedArray,
+                           MJPEGEncoder=SoftwareJpegEncoder,
+                           JpegEncoder=SoftwareJpegEncoder,
+                           LibavMjpegEncoder=SoftwareJpegEncoder,
+                           H264Encoder=StandInH264Encoder,
+                           Quality=Quality,
+                           FileOutput=FileOutput,
+                           SplittableOutput=SplittableOutput,
+                           controls=Controls(),
+                           Transform=Transform,
+                           real=False)
+
+
+# Pixel helpers
+
+def resize_nearest(array, size):
+    h, w = array.shape[:2]
+    if (w, h) == tuple(size):
+        return array
+    rows = np.arange(size[1]) * h // size[1]
+    cols = np.arange(size[0]) * w // size[0]
+    return array[rows[:, None], cols]
+
+def rgb_to_yuv420(rgb, out):
+    # Full range BT.601 into a (h*3/2, w) YUV420 array
+    h = rgb.shape[0]
+    r = rgb[:, :, 0].astype(np.int32)
+    g = rgb[:, :, 1].astype(np.int32)
+    b = rgb[:, :, 2].astype(np.int32)
+    out[:h] = (77 * r + 150 * g + 29 * b) >> 8
+    r, g, b = r[::2, ::2], g[::2, ::2], b[::2, ::2]
+    y, u, v = yuv420_planes(out)
+    np.clip(((-43 * r - 85 * g + 128 * b) >> 8) + 128, 0, 255, out=u, casting="unsafe")
+    np.clip(((128 * r - 107 * g - 21 * b) >> 8) + 128, 0, 255, out=v, casting="unsafe")
+
+def rgb_to_bayer(rgb, out, bits=12):
+    # RGGB mosaic of an RGB frame into a (h, w) uint16 array, samples in the
+    # low bits like the camera's unpacked raw formats
+    shift = bits - 8
+    out[0::2, 0::2] = rgb[0::2, 0::2, 0]
+    out[0::2, 1::2] = rgb[0::2, 1::2, 1]
+    out[1::2, 0::2] = rgb[1::2, 0::2, 1]
+    out[1::2, 1::2] = rgb[1::2, 1::2, 2]
+    out <<= shift
+
+def yuv420_planes(array):
+    # Y, U and V views of a (h*3/2, stride) YUV420 array as the camera lays it
+    # out, the full size Y plane followed by the quarter size U and V planes
+    h = array.shape[0] * 2 // 3
+    w = array.shape[1]
+    flat = array.reshape(-1)
+    q = (h // 2) * (w // 2)
+    u = flat[h * w:h * w + q].reshape(h // 2, w // 2)
+    v = flat[h * w + q:h * w + 2 * q].reshape(h // 2, w // 2)
+    return array[:h], u, v
+
+
+# Frame generators, fill a buffer for a stream of a given size
+
+class SyntheticFrames:
+    # A fixed textured gradient with a bright bar sweeping across it, cheap
+    # enough to generate at full sensor resolution
+    sensor_resolution = (4056, 3040)
+    model = "synthetic"
+
+    def __init__(self, seed=0):
+        self.rng = np.random.default_rng(seed)
+        self.bases = {}
+
+    def base(self, size):
+        if size not in self.bases:
+            w, h = size
+            x = np.linspace(0, 160, w, dtype=np.float32)
+            y = np.linspace(0, 80, h, dtype=np.float32)
+            img = np.empty((h, w, 4), np.uint8)
+            img[:, :, 0] = (x[None, :] + y[:, None]).astype(np.uint8)
+            img[:, :, 1] = (x[None, :] * 0.5 + y[:, None] * 1.5).astype(np.uint8)
+            img[:, :, 2] = (200 - y[:, None] - x[None, :] * 0.25).clip(0, 255).astype(np.uint8)
+            img[:, :, 3] = 255
+            img[:, :, :3] += self.rng.integers(0, 32, (h, w, 1), dtype=np.uint8)
+            self.bases[size] = img
+        return self.bases[size]
+
+    def next(self, n):
+        return {"ExposureTime": 10000,
+                "AnalogueGain": 1.0,
+                "DigitalGain": 1.0,
+                "SensorTemperature": 40.0,
+                "Lux": 400.0,
+                "ColourTemperature": 5000,
+                "FocusFoM": 1000}
+
+    def fill(self, n, size, out):
+        np.copyto(out, self.base(size))
+        x = (n * 16) % size[0]
+        out[:, x:x + 8, :3] = 255
+
+class ReplayFrames:
+    # Loops over the JPEGs under a directory in name order, with each image's
+    # entry from the metadata.json/metadata.jsonl alongside it
+    def __init__(self, dirname):
+        import simplejpeg
+        from metadata_log import load_metadata
+        self.simplejpeg = simplejpeg
+        self.load_metadata = load_metadata
+        self.files = sorted(glob.glob(os.path.join(dirname, "**", "*.jpg"), recursive=True))
+        self.files = [f for f in self.files if not os.path.islink(f)]
+        if not self.files:
+            raise ValueError("No JPEGs to replay under %s" % dirname)
+        self.metadata = {}
+        self.current = None
+        self.frame = None
+        with open(self.files[0], "rb") as f:
+            h, w = self.simplejpeg.decode_jpeg_header(f.read())[:2]
+        self.sensor_resolution = (w, h)
+        self.model = "replay"
+
+    def dir_metadata(self, dirname):
+        if dirname not in self.metadata:
+            md = {}
+            for name in ("metadata.jsonl", "metadata.json"):
+                if os.path.exists(os.path.join(dirname, name)):
+                    md = self.load_metadata(os.path.join(dirname, name))
+                    break
+            self.metadata[dirname] = md
+        return self.metadata[dirname]
+
+    def next(self, n):
+        filename = self.files[n % len(self.files)]
+        with open(filename, "rb") as f:
+            self.frame = self.simplejpeg.decode_jpeg(f.read(), colorspace="RGBX")
+        self.current = filename
+        md = self.dir_metadata(os.path.dirname(filename)).get(os.path.basename(filename), {})
+        return dict(md)
+
+    def fill(self, n, size, out):
+        np.copyto(out, resize_nearest(self.frame, size))
+
+
+# Camera stand-in
+
+class Transform(dict):
+    def __init__(self, hflip=False, vflip=False):
+        super().__init__(hflip=hflip, vflip=vflip)
+
+class Controls:
+    # Any libcamera.controls enum lookup, e.g. controls.rpi.SyncModeEnum.Server
+    def __getattr__(self, name):
+        return Controls()
+
+class Quality:
+    VERY_LOW, LOW, MEDIUM, HIGH, VERY_HIGH = range(5)
+
+class Request:
+    def __init__(self, camera, buffers, metadata):
+        self.camera = camera
+        self.config = camera.config
+        self.buffers = buffers
+        self.metadata = metadata
+        self.refs = 1
+
+    def release(self):
+        with self.camera.condition:
+            self.release_locked()
+
+    def release_locked(self):
+        self.refs -= 1
+        if self.refs == 0:
+            self.camera.free.append(self.buffers)
+            self.camera.condition.notify_all()
+
+    def make_array(self, name):
+        return self.buffers[name].copy()
+
+    def get_metadata(self):
+        return dict(self.metadata)
+
+class MappedArray:
+    def __init__(self, request, stream, write=True):
+        self.request = request
+        self.stream = stream
+
+    def __enter__(self):
+        self.array = self.request.buffers[self.stream]
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+class FakeCamera:
+    # Produces frames at the configured (or --sourcefps) rate on its own
+    # thread, like the real camera. A frame is dropped when every buffer is
+    # still held by a request, so holding requests too long starves it the
+    # same way.
+    def __init__(self, frames, fps=None, tuning=None, camera_num=0):
+        self.frames = frames
+        self.fps = fps
+        self.camera_num = camera_num
+        self.camera = SimpleNamespace(id="/%s/%d" % (frames.model, camera_num))
+        self.sensor_resolution = frames.sensor_resolution
+        w, h = self.sensor_resolution
+        self.sensor_modes = [{"size": (w // 4, h // 4)}, {"size": (w // 2, h // 2)}, {"size": (w, h)}]
+        self.config = None
+        self.condition = threading.Condition()
+        self.free = collections.deque()
+        self.latest = None
+        self.sequence = 0
+        self.encoders = []
+        self.running = False
+        self.thread = None
+        self.dropped = 0
+        self.pre_callback = None
+        self.post_callback = None
+
+    def create_configuration(self, main=None, lores=None, raw=None, controls=None, buffer_count=4, **kwargs):
+        config = {"main": {"size": tuple((main or {}).get("size", self.sensor_resolution)),
+                           "format": (main or {}).get("format", "XBGR8888")},
+                  "controls": dict(controls or {}),
+                  "buffer_count": buffer_count}
+        if lores is not None:
+            config["lores"] = {"size": tuple(lores["size"]), "format": "YUV420"}
+        if raw is not None:
+            config["raw"] = {"size": tuple(raw.get("size", config["main"]["size"])),
+                             "format": raw.get("format", "SRGGB12")}
+        return config
+
+    create_still_configuration = create_configuration
+    create_video_configuration = create_configuration
+    create_preview_configuration = create_configuration
+
+    def configure(self, config):
+        self.config = config
+        self.free.clear()
+        for i in range(config["buffer_count"]):
+            buffers = {}
+            for name in ("main", "lores", "raw"):
+                if name in config:
+                    w, h = config[name]["size"]
+                    if name == "raw":
+                        # Unpacked samples as bytes, as the camera maps them
+                        buffers[name] = np.empty((h, w * 2), np.uint8)
+                    elif config[name]["format"] == "YUV420":
+                        buffers[name] = np.empty((h * 3 // 2, w), np.uint8)
+                    else:
+                        buffers[name] = np.empty((h, w, 4), np.uint8)
+            self.free.append(buffers)
+
+    def frame_duration(self):
+        if self.fps:
+            return 1 / self.fps
+        controls = self.config["controls"]
+        if "FrameDurationLimits" in controls:
+            return controls["FrameDurationLimits"][0] / 1000000
+        if "FrameRate" in controls:
+            return 1 / controls["FrameRate"]
+        return 1 / 30
+
+    def set_controls(self, controls):
+        self.config["controls"].update(controls)
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        due = time.monotonic()
+        while self.running:
+            due += self.frame_duration()
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                due = time.monotonic()
+            with self.condition:
+                buffers = self.free.popleft() if self.free else None
+            if buffers is None:
+                self.dropped += 1
+                continue
+            n = self.sequence
+            metadata = self.frames.next(n)
+            metadata["SensorTimestamp"] = time.monotonic_ns()
+            metadata["FrameDuration"] = int(self.frame_duration() * 1000000)
+            self.frames.fill(n, self.config["main"]["size"], buffers["main"])
+            if "lores" in buffers:
+                rgb = resize_nearest(buffers["main"], self.config["lores"]["size"])
+                rgb_to_yuv420(rgb, buffers["lores"])
+            if "raw" in buffers:
+                w, h = self.config["raw"]["size"]
+                rgb = resize_nearest(buffers["main"], (w, h))
+                rgb_to_bayer(rgb, buffers["raw"].view(np.uint16), int(self.config["raw"]["format"][5:7]))
+            request = Request(self, buffers, metadata)
+            # Called on this thread in the same order as the real camera's
+            # event loop, so a slow callback delays every later frame
+            if self.pre_callback is not None:
+                self.pre_callback(request)
+            for encoder, name in self.encoders:
+                encoder.encode(name, request)
+            if self.post_callback is not None:
+                self.post_callback(request)
+            with self.condition:
+                if self.latest is not None:
+                    self.latest.release_locked()
+                self.latest = request
+                self.sequence += 1
+                self.condition.notify_all()
+
+    def capture_request(self):
+        with self.condition:
+            seq = self.sequence
+            self.condition.wait_for(lambda: self.sequence > seq)
+            request = self.latest
+            request.refs += 1
+        return request
+
+    def capture_array(self, name="main"):
+        request = self.capture_request()
+        array = request.make_array(name)
+        request.release()
+        return array
+
+    def start_recording(self, encoder, output, name="main", quality=None):
+        encoder.output = output
+        encoder.start()
+        self.encoders.append((encoder, name))
+        self.start()
+
+    def stop_recording(self):
+        self.stop()
+        for encoder, name in self.encoders:
+            encoder.stop()
+        self.encoders = []
+
+    def close(self):
+        self.stop()
+
+
+# Encoder and output stand-ins
+
+class FileOutput:
+    def __init__(self, file=None):
+        self.file = file
+        self.opened = None
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, packet=None, audio=False):
+        if isinstance(self.file, str):
+            if self.opened is None:
+                self.opened = open(self.file, "wb")
+            self.opened.write(frame)
+        elif self.file is not None:
+            self.file.write(frame)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        if self.opened is not None:
+            self.opened.close()
+            self.opened = None
+
+class SplittableOutput:
+    def __init__(self, output=None):
+        self.output = output
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, packet=None, audio=False):
+        if self.output is not None:
+            self.output.outputframe(frame, keyframe, timestamp)
+
+    def split_output(self, output, wait_for_keyframe=True):
+        old, self.output = self.output, output
+        if old is not None:
+            old.stop()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        if self.output is not None:
+            self.output.stop()
+
+class SoftwareJpegEncoder:
+    # Stands in for the MJPEG/JPEG encoders, encodes with simplejpeg on the
+    # camera thread
+    def __init__(self, bitrate=None, q=None, quality=85):
+        import simplejpeg
+        self.simplejpeg = simplejpeg
+        self.bitrate = bitrate
+        self.quality = q or quality
+        self.output = None
+        self.size = None
+        self.format = None
+        self.framerate = None
+        self.frames = 0
+
+    def start(self):
+        pass
+
+    def stop(self):
+        if self.output is not None:
+            self.output.stop()
+
+    def keyframe(self):
+        return True
+
+    def encode(self, name, request):
+        array = request.buffers[name]
+        if array.ndim == 2:
+            y, u, v = yuv420_planes(array)
+            frame = self.simplejpeg.encode_jpeg_yuv_planes(y, u, v, quality=self.quality)
+        else:
+            frame = self.simplejpeg.encode_jpeg(array, quality=self.quality, colorspace="RGBX", colorsubsampling="420")
+        keyframe = self.keyframe()
+        self.frames += 1
+        if self.output is not None:
+            self.output.outputframe(frame, keyframe, request.metadata.get("SensorTimestamp"))
+
+class StandInH264Encoder(SoftwareJpegEncoder):
+    # There is no software H.264, this emits JPEGs at a low quality with
+    # every iperiod'th flagged as a keyframe, so outputs see a similar
+    # stream of frames and keyframes to buffer and split
+    def __init__(self, bitrate=None, repeat=True, iperiod=30, **kwargs):
+        super().__init__(bitrate=bitrate, quality=40)
+        self.iperiod = iperiod
+
+    def keyframe(self):
+        return self.frames % self.iperiod == 0
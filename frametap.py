@@ -0,0 +1,93 @@
+import time
+import threading
+
+import numpy as np
+
+# Frames from a running recording without asking the camera for requests of
+# our own. Installed as picam2.post_callback, it is handed every completed
+# request on the camera's thread. When one of its consumers is due, the
+# stream's plane is copied into a buffer the tap owns inside the mapping and
+# the request goes straight back, the consumers then run on the tap's own
+# thread. A frame arriving while they are still busy is skipped rather than
+# queued, so what they see is never more than a frame old and the encoders
+# recording the stream never wait for a free buffer.
+
+class Consumer:
+    def __init__(self, fn, fps, wanted=None):
+        self.fn = fn
+        self.interval = 1 / fps if fps else 0.0
+        self.wanted = wanted
+        self.due = 0.0
+        self.pending = False
+
+    def ready(self, now):
+        if now < self.due:
+            return False
+        if self.wanted is not None and not self.wanted(now):
+            return False
+        self.due = max(self.due + self.interval, now)
+        return True
+
+class FrameTap:
+    def __init__(self, mapped_array, name="lores"):
+        self.mapped_array = mapped_array
+        self.name = name
+        self.consumers = []
+        self.buffer = None
+        self.busy = False
+        self.condition = threading.Condition()
+        self.frames = 0
+        self.skipped = 0
+        self.copy_time = None
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def add(self, fn, fps=None, wanted=None):
+        # fn(array) at up to fps frames a second, and only while wanted(now)
+        # (if given) says so, e.g. while a stream has subscribers
+        self.consumers.append(Consumer(fn, fps, wanted))
+
+    def __call__(self, request):
+        now = time.monotonic()
+        with self.condition:
+            if self.busy:
+                if any(now >= c.due for c in self.consumers):
+                    self.skipped += 1
+                return
+            due = [c for c in self.consumers if c.ready(now)]
+            if not due:
+                return
+            t0 = time.perf_counter()
+            with self.mapped_array(request, self.name) as m:
+                if self.buffer is None or self.buffer.shape != m.array.shape:
+                    self.buffer = np.empty_like(m.array)
+                np.copyto(self.buffer, m.array)
+            if self.copy_time is not None:
+                self.copy_time.observe(time.perf_counter() - t0)
+            for c in due:
+                c.pending = True
+            self.busy = True
+            self.frames += 1
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.busy)
+                due = [c for c in self.consumers if c.pending]
+            try:
+                for c in due:
+                    c.pending = False
+                    try:
+                        c.fn(self.buffer)
+                    except Exception as e:
+                        # One failing consumer mustn't stop the others, or
+                        # this thread, for good
+                        print("Frame tap consumer %s failed: %s" % (getattr(c.fn, "__name__", c.fn), e))
+            finally:
+                with self.condition:
+                    self.busy = False
+
+    def add_metrics(self, registry):
+        self.copy_time = registry.histogram("tap_copy_seconds", "Time a request is held copying the tapped plane")
+        registry.counter("tap_frames_total", "Frames copied for tap consumers", fn=lambda: self.frames)
+        registry.counter("tap_skipped_total", "Frames skipped while tap consumers were busy", fn=lambda: self.skipped)
@@ -1,19 +1,19 @@
 #!/usr/bin/python3
 
-import io
-import logging
-import socketserver
-from http import server
-from threading import Condition
+import os
+import time
+import json
+import argparse
 import threading
+from concurrent.futures import ThreadPoolExecutor
 import simplejpeg
 import numpy as np
 
-from picamera2 import Picamera2
-from picamera2.encoders import MJPEGEncoder
-from picamera2.encoders import JpegEncoder
-from picamera2.encoders import LibavMjpegEncoder
-from picamera2.outputs import FileOutput
+import framesource
+import metrics
+from broadcast import FrameBroadcast, POLICIES, sse_event, SSE_CONTENT_TYPE
+import focus
+from streaming import serve, SERVERS
 
 w=800
 h=600
@@ -33,89 +33,202 @@ PAGE = """\
 <tr><td><img src="stream2.mjpg" width="{w2}" height="{h2}" /></td><td><img src="stream3.mjpg" width="{w2}" height="{h2}" /></td></tr>
 <tr><td colspan="2"><img src="stream4.mjpg" width="{w}" height="{h2}" /></td></tr>
 <tr><td><img src="stream5.mjpg" width="{w2}" height="{h2}" /></td><td><img src="stream6.mjpg" width="{w2}" height="{h2}" /></td></tr>
+</table>
+{focus}
 </body>
 </html>
-""".format(w=w,h=h,w2=w2,h2=h2)
-
-
-class StreamingOutput(io.BufferedIOBase):
-    def __init__(self):
-        self.frame = None
-        self.condition = Condition()
-
-    def write(self, buf):
-        with self.condition:
-            self.frame = buf
-            self.condition.notify_all()
-
-output = StreamingOutput()
-output2 = StreamingOutput()
-output3 = StreamingOutput()
-output4 = StreamingOutput()
-output5 = StreamingOutput()
-output6 = StreamingOutput()
-
-class StreamingHandler(server.BaseHTTPRequestHandler):
-    def do_GET(self):
-        streams={'/stream.mjpg':output,
-                 '/stream2.mjpg':output2,
-                 '/stream3.mjpg':output3,
-                 '/stream4.mjpg':output4,
-                 '/stream5.mjpg':output5,
-                 '/stream6.mjpg':output6,}
-        if self.path == '/':
-            self.send_response(301)
-            self.send_header('Location', '/index.html')
-            self.end_headers()
-        elif self.path == '/index.html':
-            content = PAGE.encode('utf-8')
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/html')
-            self.send_header('Content-Length', len(content))
-            self.end_headers()
-            self.wfile.write(content)
-        elif self.path in streams:
-            op=streams[self.path]
-            self.send_response(200)
-            self.send_header('Age', 0)
-            self.send_header('Cache-Control', 'no-cache, private')
-            self.send_header('Pragma', 'no-cache')
-            self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
-            self.end_headers()
-            try:
-                while True:
-                    with op.condition:
-                        op.condition.wait()
-                        frame = op.frame
-                    self.wfile.write(b'--FRAME\r\n')
-                    self.send_header('Content-Type', 'image/jpeg')
-                    self.send_header('Content-Length', len(frame))
-                    self.end_headers()
-                    self.wfile.write(frame)
-                    self.wfile.write(b'\r\n')
-            except Exception as e:
-                logging.warning(
-                    'Removed streaming client %s: %s',
-                    self.client_address, str(e))
-        else:
-            self.send_error(404)
-            self.end_headers()
-
-
-class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
-    allow_reuse_address = True
-    daemon_threads = True
+"""
+
+ROI_PAGE = """\
+<html>
+<head>
+<title>Framing and Focus tool</title>
+</head>
+<body>
+<h1>Framing and Focus tool</h1>
+<img src="stream.mjpg" width="{w}" height="{h}" />
+<table>
+{rows}
+</table>
+{focus}
+</body>
+</html>
+"""
+
+FOCUS_SNIPPET = """\
+<pre id="focus"></pre>
+<script>
+new EventSource("focus.events").onmessage = function(e) {
+  var d = JSON.parse(e.data), t = "ROI          laplacian    tenengrad\\n";
+  d.rois.forEach(function(r) { t += r.name.padEnd(12) + r.laplacian.toFixed(1).padStart(10) + r.tenengrad.toFixed(1).padStart(13) + "\\n"; });
+  document.getElementById("focus").textContent = t;
+};
+</script>
+"""
 
-def start_server():
-    address = ('', 8000)
-    server = StreamingServer(address, StreamingHandler)
-    print(server.__dict__.keys())
-    server.serve_forever()
+
+parser = argparse.ArgumentParser(description='Framing and focus tool', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--port', type=int, default=8000, help='HTTP port')
+parser.add_argument('--lagpolicy', type=str, default="latest", choices=POLICIES, help='What to do with a client more than --maxlag frames behind')
+parser.add_argument('--maxlag', type=int, default=2, help='Frames a client may fall behind')
+parser.add_argument('--focusfps', type=float, default=3.0, help='Target refresh rate of the focus crops and metrics')
+parser.add_argument('--encodethreads', type=int, default=os.cpu_count(), help='Threads encoding focus crops')
+parser.add_argument('--grid', type=str, default=None, help='Divide the frame into an NxM (columns x rows) grid of ROIs')
+parser.add_argument('--roi', type=str, action='append', default=[], help='ROI as x,y,w,h in pixels or fractions of the frame, may be repeated')
+parser.add_argument('--focusscale', type=int, default=2, help='Subsampling of the luma plane the focus metrics are computed on')
+parser.add_argument('--server', type=str, default="threading", choices=SERVERS, help='HTTP server, a thread per client or a single asyncio loop')
+framesource.add_source_arguments(parser)
+metrics.add_metrics_arguments(parser)
+args = parser.parse_args()
+
+cam=framesource.camera_module(args.source,args.sourcefps)
+Picamera2, MappedArray = cam.Picamera2, cam.MappedArray
+MJPEGEncoder, JpegEncoder, LibavMjpegEncoder, FileOutput = cam.MJPEGEncoder, cam.JpegEncoder, cam.LibavMjpegEncoder, cam.FileOutput
 
 picam2 = Picamera2()
 r=picam2.sensor_modes[2]
 fullsize=picam2.sensor_resolution
 streamsize=(w,h)
+
+class Crop:
+    # Full resolution ROI feeding one stream, the stream shows at most w x h
+    # pixels from the centre of the ROI. Only streams somebody is watching
+    # are copied out of the request, into a buffer reused every time, and
+    # encoded on the pool after the request has been released.
+    def __init__(self,name,rect):
+        self.name=name
+        self.rect=rect
+        self.output=FrameBroadcast()
+        x,y,rw,rh=rect
+        cw,ch=min(rw,w),min(rh,h)
+        x+=(rw-cw)//2
+        y+=(rh-ch)//2
+        self.rows=slice(y,y+ch)
+        self.cols=slice(x,x+cw)
+        self.buf=None
+        self.busy=False
+
+    def secure(self,array):
+        view=array[self.rows,self.cols]
+        if self.buf is None:
+            self.buf=np.empty(view.shape,view.dtype)
+        np.copyto(self.buf,view)
+        self.busy=True
+
+    def encode(self):
+        try:
+            t0=time.perf_counter()
+            self.output.write(simplejpeg.encode_jpeg(self.buf, quality=65, colorspace="RGBX", colorsubsampling='420'))
+            crop_encode_time.observe(time.perf_counter()-t0)
+        finally:
+            self.busy=False
+
+class FocusMeter:
+    # Sharpness of every ROI on a subsampled luma plane. The plane is taken
+    # from the request on the capture thread, the metrics are computed on
+    # the pool and pushed to /focus.events, /focus.json can also measure
+    # extra ROIs given in its query string against the latest plane.
+    # Measuring stops with no one asking, so a query then waits for the
+    # next frame's results rather than answer with none or stale ones.
+    def __init__(self,crops,scale,timeout):
+        self.crops=crops
+        self.scale=scale
+        self.luma=None
+        self.seq=0
+        self.timestamp=None
+        self.results=[]
+        self.busy=False
+        self.lastquery=None
+        self.timeout=timeout
+        self.measured=threading.Condition()
+        self.events=FrameBroadcast(framing=sse_event,content_type=SSE_CONTENT_TYPE)
+
+    def wanted(self):
+        return not self.busy and (self.events.has_subscribers() or self.recent())
+
+    def recent(self):
+        return self.lastquery is not None and time.monotonic()-self.lastquery < 5
+
+    def secure(self,array):
+        self.busy=True
+        self.pending=focus.luma(array,self.scale)
+
+    def measure(self):
+        try:
+            t0=time.perf_counter()
+            y=self.pending
+            results=[]
+            for c in self.crops:
+                results.append(dict(name=c.name,rect=c.rect,**focus.measure(y,c.rect,self.scale)))
+            with self.measured:
+                self.luma=y
+                self.seq+=1
+                self.timestamp=time.time()
+                self.results=results
+                self.measured.notify_all()
+            self.events.write(json.dumps(self.report(results)).encode())
+            measure_time.observe(time.perf_counter()-t0)
+        finally:
+            self.busy=False
+
+    def report(self,results):
+        return {"seq":self.seq,"time":self.timestamp,"scale":self.scale,"rois":results}
+
+    def query(self,params):
+        rois=[focus.parse_roi(s,fullsize) for s in params.get('roi',[])]
+        with self.measured:
+            stale=self.luma is None or not (self.recent() or self.events.has_subscribers())
+            self.lastquery=time.monotonic()
+            seq=self.seq
+            if stale and not self.measured.wait_for(lambda: self.seq!=seq,timeout=self.timeout):
+                raise ValueError("No frame measured yet, still warming up")
+            results=list(self.results)
+            luma=self.luma
+        for i,rect in enumerate(rois):
+            results.append(dict(name="query%d"%i,rect=rect,**focus.measure(luma,rect,self.scale)))
+        return 'application/json', json.dumps(self.report(results)).encode()
+
+if args.grid or args.roi:
+    rects=[]
+    if args.grid:
+        rects+=focus.parse_grid(args.grid,fullsize)
+    rects+=[focus.parse_roi(s,fullsize) for s in args.roi]
+    crops=[Crop("roi%d"%i,rect) for i,rect in enumerate(rects)]
+    rows="\n".join('<tr><td><img src="{name}.mjpg" width="{w}" height="{h}" /><br/>{name} {rect}</td></tr>'.format(
+        name=c.name,rect=c.rect,w=c.cols.stop-c.cols.start,h=c.rows.stop-c.rows.start) for c in crops)
+    page=ROI_PAGE.format(w=w,h=h,rows=rows,focus=FOCUS_SNIPPET)
+else:
+    # The original four corners and a strip across the centre
+    crops=[Crop("stream2",(0,0,w2,h2)),
+           Crop("stream3",(fullsize[0]-w2,0,w2,h2)),
+           Crop("stream4",(int(fullsize[0]/2-w2),int(fullsize[1]/2-95),2*w2,190)),
+           Crop("stream5",(0,fullsize[1]-h2,w2,h2)),
+           Crop("stream6",(fullsize[0]-w2,fullsize[1]-h2,w2,h2))]
+    page=PAGE.format(w=w,h=h,w2=w2,h2=h2,focus=FOCUS_SNIPPET)
+
+output = FrameBroadcast()
+meter = FocusMeter(crops,args.focusscale,2+2/args.focusfps)
+
+streams={'/stream.mjpg':output,
+         '/focus.events':meter.events}
+for c in crops:
+    streams['/%s.mjpg'%c.name]=c.output
+
+registry=metrics.REGISTRY
+for path,stream in streams.items():
+    registry.add_stream(path,stream)
+capture_time=registry.histogram("capture_wait_seconds","Time waiting for the camera to return a frame")
+crop_encode_time=registry.histogram("focus_crop_encode_seconds","Time encoding a focus crop")
+measure_time=registry.histogram("focus_measure_seconds","Time computing the focus metrics for every ROI")
+if args.metricslog:
+    registry.start_logging(args.metricslog)
+
+# simplejpeg and the NumPy metrics release the GIL so the pool runs in parallel
+encoder_pool=ThreadPoolExecutor(max_workers=args.encodethreads)
+
+def start_server():
+    serve(('', args.port), page, streams, args.lagpolicy, args.maxlag, args.server, endpoints={'/focus.json':meter.query,'/metrics':registry.endpoint})
+
 #picam2.configure(picam2.create_video_configuration({"size": size},raw=r))
 
 #config = picam2.create_video_configuration({"size": fullsize}, lores={"size": streamsize},raw=r,controls={'FrameRate': 10,},buffer_count=3)
@@ -134,24 +247,31 @@ try:
     #server.serve_forever()
     threading.Thread(target=start_server).start()
 
-    counter=0
+    interval=1/args.focusfps
+    due=0
     while True:
+        t0=time.perf_counter()
         request = picam2.capture_request()
-        if counter%4 == 0:
-            array=request.make_array("main")
-            f2=np.ascontiguousarray(array[:h2,:w2])
-            output2.write(simplejpeg.encode_jpeg(f2, quality=65, colorspace="RGBX", colorsubsampling='420'))
-            f3=np.ascontiguousarray(array[:h2,-w2:])
-            output3.write(simplejpeg.encode_jpeg(f3, quality=65, colorspace="RGBX", colorsubsampling='420'))
-            f4=np.ascontiguousarray(array[int(fullsize[1]/2-95):int(fullsize[1]/2+95),int(fullsize[0]/2-w2):int(fullsize[0]/2+w2)])
-            output4.write(simplejpeg.encode_jpeg(f4, quality=65, colorspace="RGBX", colorsubsampling='420'))
-            f5=np.ascontiguousarray(array[-h2:,:w2])
-            output5.write(simplejpeg.encode_jpeg(f5, quality=65, colorspace="RGBX", colorsubsampling='420'))
-            f6=np.ascontiguousarray(array[-h2:,-w2:])
-            output6.write(simplejpeg.encode_jpeg(f6, quality=65, colorspace="RGBX", colorsubsampling='420'))
-            a=None
-        counter+=1
+        capture_time.observe(time.perf_counter()-t0)
+        wanted=[]
+        measure=False
+        now=time.monotonic()
+        if now >= due:
+            # Skip crops still encoding the last copy rather than queue behind them
+            wanted=[c for c in crops if c.output.has_subscribers() and not c.busy]
+            measure=meter.wanted()
+            if wanted or measure:
+                due=max(due+interval,now)
+                with MappedArray(request, "main") as m:
+                    for c in wanted:
+                        c.secure(m.array)
+                    if measure:
+                        meter.secure(m.array)
         request.release()
+        for c in wanted:
+            encoder_pool.submit(c.encode)
+        if measure:
+            encoder_pool.submit(meter.measure)
 
 finally:
     picam2.stop_recording()
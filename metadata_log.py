@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+import os
+import sys
+import time
+import json
+import argparse
+import threading
+
+# Append-only JSON-Lines metadata store. Each frame adds one line
+# {"name": ..., "metadata": {...}} to the log and one "name<TAB>offset" line
+# to the sidecar index, so the per-frame cost does not grow through the day.
+
+INDEX_SUFFIX = ".idx"
+
+class MetadataLog:
+    def __init__(self, syncevery=10, syncinterval=60.0):
+        self.syncevery = syncevery
+        self.syncinterval = syncinterval
+        self.filename = None
+        self.file = None
+        self.index = None
+        self.pending = 0
+        self.lastsync = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _open(self, filename):
+        self._close()
+        dirname = os.path.dirname(filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.file = open(filename, "ab")
+        self.index = open(filename + INDEX_SUFFIX, "ab")
+        self.filename = filename
+
+    def _sync(self):
+        for f in (self.file, self.index):
+            f.flush()
+            os.fsync(f.fileno())
+        self.pending = 0
+        self.lastsync = time.monotonic()
+
+    def _close(self):
+        if self.file is not None:
+            self._sync()
+            self.file.close()
+            self.index.close()
+        self.file = None
+        self.index = None
+        self.filename = None
+
+    def append(self, filename, name, metadata):
+        line = json.dumps({"name": name, "metadata": metadata}, sort_keys=True).encode() + b"\n"
+        with self.lock:
+            if filename != self.filename:
+                self._open(filename)
+            offset = self.file.tell()
+            self.file.write(line)
+            self.index.write(b"%s\t%d\n" % (name.encode(), offset))
+            # Hand the data to the OS every frame, but only force it out to
+            # the card every syncevery frames or syncinterval seconds
+            self.file.flush()
+            self.index.flush()
+            self.pending += 1
+            if self.pending >= self.syncevery or time.monotonic() - self.lastsync >= self.syncinterval:
+                self._sync()
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+
+def read_log(filename):
+    with open(filename, "rb") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.decoder.JSONDecodeError:
+                # Most likely a partial line from a crash mid-write
+                print("Skipping invalid metadata line in %s" % filename, file=sys.stderr)
+                continue
+            yield entry["name"], entry["metadata"]
+
+def read_index(filename):
+    index = {}
+    indexname = filename + INDEX_SUFFIX
+    if not os.path.exists(indexname):
+        return rebuild_index(filename)
+    with open(indexname, "rb") as f:
+        for line in f:
+            try:
+                name, offset = line.rstrip(b"\n").rsplit(b"\t", 1)
+                index[name.decode()] = int(offset)
+            except ValueError:
+                continue
+    return index
+
+def rebuild_index(filename):
+    index = {}
+    with open(filename, "rb") as f, open(filename + INDEX_SUFFIX + ".new", "wb") as idx:
+        offset = 0
+        for line in f:
+            try:
+                name = json.loads(line)["name"]
+            except json.decoder.JSONDecodeError:
+                offset += len(line)
+                continue
+            index[name] = offset
+            idx.write(b"%s\t%d\n" % (name.encode(), offset))
+            offset += len(line)
+    os.rename(filename + INDEX_SUFFIX + ".new", filename + INDEX_SUFFIX)
+    return index
+
+def lookup(filename, name, index=None):
+    if index is None:
+        index = read_index(filename)
+    with open(filename, "rb") as f:
+        f.seek(index[name])
+        return json.loads(f.readline())["metadata"]
+
+def line_objects(line):
+    # Every JSON value on a line, a log appended to a legacy file starts on
+    # the same line as its dict as that has no newline at the end
+    decoder = json.JSONDecoder()
+    text = line.decode().strip()
+    pos = 0
+    while pos < len(text):
+        value, pos = decoder.raw_decode(text, pos)
+        yield value
+        while pos < len(text) and text[pos].isspace():
+            pos += 1
+
+def load_metadata(filename):
+    # Returns the legacy {filename: metadata} dict for a log or a legacy
+    # file whatever they are called, or a legacy file with log lines
+    # appended to it (what older versions did given a .json name)
+    mdjson = {}
+    entries = 0
+    invalid = 0
+    with open(filename, "rb") as f:
+        for line in f:
+            try:
+                objects = list(line_objects(line))
+            except (json.decoder.JSONDecodeError, UnicodeDecodeError):
+                invalid += 1
+                continue
+            for entry in objects:
+                if not isinstance(entry, dict):
+                    invalid += 1
+                    continue
+                entries += 1
+                if set(entry) == {"name", "metadata"}:
+                    mdjson[entry["name"]] = entry["metadata"]
+                else:
+                    mdjson.update(entry)
+    if entries == 0 and os.path.getsize(filename) > 0:
+        # A legacy file written over several lines, e.g. pretty printed
+        with open(filename) as f:
+            return json.load(f)
+    if invalid:
+        # Most likely a partial line from a crash mid-write
+        print("Skipping %d invalid metadata lines in %s" % (invalid, filename), file=sys.stderr)
+    return mdjson
+
+def export_legacy(filename, output):
+    mdjson = load_metadata(filename)
+    with open(output + ".new", "w") as f:
+        f.write(json.dumps(mdjson, sort_keys=True))
+    os.rename(output + ".new", output)
+    return len(mdjson)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Timelapse metadata log tool', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    exportparser = subparsers.add_parser('export', help='Write the legacy dict style metadata.json for a log')
+    exportparser.add_argument('log', type=str, nargs='+', help='metadata.jsonl log file(s)')
+    exportparser.add_argument('--output', type=str, default=None, help='Output filename, defaults to metadata.json alongside each log')
+
+    getparser = subparsers.add_parser('get', help='Print the metadata for one image using the index')
+    getparser.add_argument('log', type=str, help='metadata.jsonl log file')
+    getparser.add_argument('name', type=str, help='Image filename')
+
+    indexparser = subparsers.add_parser('reindex', help='Rebuild the index for a log')
+    indexparser.add_argument('log', type=str, nargs='+', help='metadata.jsonl log file(s)')
+
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        if args.output is not None and len(args.log) > 1:
+            parser.error("--output can only be used with a single log")
+        outputs = [args.output or os.path.join(os.path.dirname(log), "metadata.json") for log in args.log]
+        for log, output in zip(args.log, outputs):
+            if os.path.abspath(output) == os.path.abspath(log):
+                parser.error("won't export %s over itself, give another --output" % log)
+        for log, output in zip(args.log, outputs):
+            n = export_legacy(log, output)
+            print("Exported %d entries from %s to %s" % (n, log, output))
+    elif args.command == 'get':
+        print(json.dumps(lookup(args.log, os.path.basename(args.name)), sort_keys=True, indent=1))
+    elif args.command == 'reindex':
+        for log in args.log:
+            print("Indexed %d entries in %s" % (len(rebuild_index(log)), log))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+import time
+import bisect
+import logging
+import numbers
+import threading
+
+# Hot path instrumentation. Histograms have fixed buckets whose counts live
+# in a list allocated up front, so an observation is a bisect and two adds
+# under a lock. Counters and gauges can be given a function instead, which
+# is only called when the metrics are rendered, e.g. to read a
+# FrameBroadcast's counts. Rendered in the Prometheus text format for
+# /metrics, or as a one line summary for the log.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, 100us to 30s
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in sorted(labels.items()))
+
+def format_value(v):
+    # Plain ints and floats, values read from NumPy come back as its scalars
+    if isinstance(v, numbers.Integral):
+        return "%d" % v
+    return repr(float(v))
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, labels=None, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.count, self.sum
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q'th observation
+        counts, count, total = self.snapshot()
+        if count == 0:
+            return 0.0
+        target = q * count
+        seen = 0
+        for bound, n in zip(self.buckets, counts):
+            seen += n
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def render(self):
+        counts, count, total = self.snapshot()
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float("inf"),), counts):
+            cumulative += n
+            labels = dict(self.labels, le="+Inf" if bound == float("inf") else repr(bound))
+            lines.append("%s_bucket%s %d" % (self.name, format_labels(labels), cumulative))
+        lines.append("%s_sum%s %s" % (self.name, format_labels(self.labels), format_value(total)))
+        lines.append("%s_count%s %d" % (self.name, format_labels(self.labels), count))
+        return lines
+
+    def empty(self):
+        return self.count == 0
+
+    def summary(self):
+        counts, count, total = self.snapshot()
+        mean = total / count * 1000 if count else 0.0
+        return "%s n=%d mean=%.1fms p99<%gms" % (self.name, count, mean, self.quantile(0.99) * 1000)
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labels=None, fn=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.fn = fn
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def get(self):
+        return self.fn() if self.fn is not None else self.value
+
+    def render(self):
+        return ["%s%s %s" % (self.name, format_labels(self.labels), format_value(self.get()))]
+
+    def empty(self):
+        return not self.get()
+
+    def summary(self):
+        return "%s%s=%s" % (self.name, format_labels(self.labels), format_value(self.get()))
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value):
+        self.value = value
+
+class Registry:
+    def __init__(self, prefix=""):
+        self.prefix = prefix
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def add(self, metric):
+        metric.name = self.prefix + metric.name
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=None, buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def counter(self, name, help, labels=None, fn=None):
+        return self.add(Counter(name, help, labels, fn))
+
+    def gauge(self, name, help, labels=None, fn=None):
+        return self.add(Gauge(name, help, labels, fn))
+
+    def add_stream(self, path, output):
+        # The FrameBroadcast feeding a stream keeps its own counts, read at
+        # render time
+        labels = {"stream": path}
+        self.counter("stream_frames_produced_total", "Frames written to the stream", labels, lambda: output.seq)
+        self.counter("stream_frames_sent_total", "Frames handed to clients", labels, lambda: output.sent)
+        self.counter("stream_frames_skipped_total", "Frames lagging clients skipped", labels, lambda: output.skipped)
+        self.gauge("stream_clients", "Clients connected", labels, lambda: output.subscribers)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        # Every sample of a metric goes together under one HELP/TYPE
+        families = {}
+        for m in metrics:
+            families.setdefault(m.name, []).append(m)
+        lines = []
+        for name, family in families.items():
+            lines.append("# HELP %s %s" % (name, family[0].help))
+            lines.append("# TYPE %s %s" % (name, family[0].type))
+            for m in family:
+                lines.extend(m.render())
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+    def endpoint(self, params):
+        # For the endpoints argument of streaming.serve
+        return CONTENT_TYPE, self.render()
+
+    def summary(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        return " ".join(m.summary() for m in metrics if not m.empty())
+
+    def start_logging(self, interval):
+        def run():
+            while True:
+                time.sleep(interval)
+                logging.warning("metrics %s", self.summary())
+        threading.Thread(target=run, daemon=True).start()
+
+REGISTRY = Registry()
+
+def add_metrics_arguments(parser, port=False):
+    if port:
+        parser.add_argument('--metricsport', type=int, default=None, help='Serve Prometheus metrics on this port at /metrics')
+    parser.add_argument('--metricslog', type=float, default=None, help='Log a metrics summary every this many seconds')
@@ -2,15 +2,16 @@
 
 # This is the same as mjpeg_server.py, but uses the h/w MJPEG encoder.
 
-import io
-import logging
-import socketserver
-from http import server
-from threading import Condition
+import time
+import argparse
+import threading
 
-from picamera2 import Picamera2
-from picamera2.encoders import MJPEGEncoder, Quality, JpegEncoder
-from picamera2.outputs import FileOutput
+import framesource
+import metrics
+import adaptive
+import simulcast
+from broadcast import FrameBroadcast, POLICIES
+from streaming import serve, SERVERS
 
 PAGE = """\
 <html>
@@ -24,72 +25,66 @@ PAGE = """\
 </html>
 """
 
+parser = argparse.ArgumentParser(description='MJPEG streaming server', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--port', type=int, default=8000, help='HTTP port')
+parser.add_argument('--lagpolicy', type=str, default="latest", choices=POLICIES, help='What to do with a client more than --maxlag frames behind')
+parser.add_argument('--maxlag', type=int, default=2, help='Frames a client may fall behind')
+parser.add_argument('--server', type=str, default="threading", choices=SERVERS, help='HTTP server, a thread per client or a single asyncio loop')
+framesource.add_source_arguments(parser)
+metrics.add_metrics_arguments(parser)
+adaptive.add_adaptive_arguments(parser)
+simulcast.add_simulcast_arguments(parser)
+args = parser.parse_args()
+if args.adaptive and args.simulcast:
+    parser.error("--adaptive and --simulcast can't be combined")
 
-class StreamingOutput(io.BufferedIOBase):
-    def __init__(self):
-        self.frame = None
-        self.condition = Condition()
+cam = framesource.camera_module(args.source, args.sourcefps)
+Picamera2, MappedArray = cam.Picamera2, cam.MappedArray
+MJPEGEncoder, Quality, JpegEncoder, FileOutput = cam.MJPEGEncoder, cam.Quality, cam.JpegEncoder, cam.FileOutput
 
-    def write(self, buf):
-        with self.condition:
-            self.frame = buf
-            self.condition.notify_all()
-
-
-class StreamingHandler(server.BaseHTTPRequestHandler):
-    def do_GET(self):
-        if self.path == '/':
-            self.send_response(301)
-            self.send_header('Location', '/index.html')
-            self.end_headers()
-        elif self.path == '/index.html':
-            content = PAGE.encode('utf-8')
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/html')
-            self.send_header('Content-Length', len(content))
-            self.end_headers()
-            self.wfile.write(content)
-        elif self.path == '/stream.mjpg':
-            self.send_response(200)
-            self.send_header('Age', 0)
-            self.send_header('Cache-Control', 'no-cache, private')
-            self.send_header('Pragma', 'no-cache')
-            self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
-            self.end_headers()
-            try:
-                while True:
-                    with output.condition:
-                        output.condition.wait()
-                        frame = output.frame
-                    self.wfile.write(b'--FRAME\r\n')
-                    self.send_header('Content-Type', 'image/jpeg')
-                    self.send_header('Content-Length', len(frame))
-                    self.end_headers()
-                    self.wfile.write(frame)
-                    self.wfile.write(b'\r\n')
-            except Exception as e:
-                logging.warning(
-                    'Removed streaming client %s: %s',
-                    self.client_address, str(e))
-        else:
-            self.send_error(404)
-            self.end_headers()
+picam2 = Picamera2()
+config = picam2.create_video_configuration(main={"size": (1280, 720)},sensor = {'output_size': picam2.sensor_resolution},controls={"FrameDurationLimits": (125000, 125000)},buffer_count=3)
+picam2.configure(config)
+output = FrameBroadcast()
+streams = {'/stream.mjpg': output}
 
+registry = metrics.REGISTRY
 
-class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
-    allow_reuse_address = True
-    daemon_threads = True
+def software_capture(stream):
+    # Frames are only copied out of the request when the stream wants one
+    # (it has viewers, and for --adaptive the controller's rate), and
+    # encoded after the request has gone back to the camera
+    while True:
+        request = picam2.capture_request()
+        wanted = stream.wanted(time.monotonic())
+        if wanted:
+            with MappedArray(request, "main") as m:
+                stream.secure(m.array)
+        request.release()
+        if wanted:
+            stream.encode()
 
+if args.adaptive:
+    controller = adaptive.controller_from_args(args)
+    controller.add_metrics(registry)
+    picam2.start()
+    threading.Thread(target=software_capture, args=(adaptive.AdaptiveStream(output, controller, config["main"]["format"]),), daemon=True).start()
+elif args.simulcast:
+    renditions = simulcast.Simulcast(config["main"]["format"], config["main"]["size"], args.simulcast, args.simulcastquality)
+    streams = renditions.streams('/stream.mjpg')
+    picam2.start()
+    threading.Thread(target=software_capture, args=(renditions,), daemon=True).start()
+else:
+    picam2.start_recording(MJPEGEncoder(bitrate=50000000), FileOutput(output))
+    #picam2.start_recording(JpegEncoder(), FileOutput(output),quality=Quality.VERY_HIGH)
 
-picam2 = Picamera2()
-picam2.configure(picam2.create_video_configuration(main={"size": (1280, 720)},sensor = {'output_size': picam2.sensor_resolution},controls={"FrameDurationLimits": (125000, 125000)},buffer_count=3))
-output = StreamingOutput()
-picam2.start_recording(MJPEGEncoder(bitrate=50000000), FileOutput(output))
-#picam2.start_recording(JpegEncoder(), FileOutput(output),quality=Quality.VERY_HIGH)
+for path, stream in streams.items():
+    if not callable(stream):
+        registry.add_stream(path, stream)
+if args.metricslog:
+    registry.start_logging(args.metricslog)
 
 try:
-    address = ('', 8000)
-    server = StreamingServer(address, StreamingHandler)
-    server.serve_forever()
+    serve(('', args.port), PAGE, streams, args.lagpolicy, args.maxlag, args.server, endpoints={'/metrics': registry.endpoint}, sndbuf=adaptive.sndbuf_from_args(args))
 finally:
     picam2.stop_recording()
@@ -0,0 +1,28 @@
+import numpy as np
+
+# Frame differencing motion detector for the lores luma plane. Every
+# scale'th pixel of each row and column is compared with the same pixel of
+# the last frame checked, motion is more than fraction of them changing by
+# more than threshold. Buffers are allocated on the first frame and reused.
+
+class MotionDetector:
+    def __init__(self, threshold=20, fraction=0.005, scale=4):
+        self.threshold = threshold
+        self.fraction = fraction
+        self.scale = scale
+        self.previous = None
+        self.level = 0.0
+
+    def update(self, y):
+        small = y[::self.scale, ::self.scale]
+        if self.previous is None or self.previous.shape != small.shape:
+            self.previous = small.copy()
+            self.diff = np.empty(small.shape, np.int16)
+            self.changed = np.empty(small.shape, np.bool_)
+            return False
+        np.subtract(small, self.previous, out=self.diff, dtype=np.int16)
+        np.abs(self.diff, out=self.diff)
+        np.greater(self.diff, self.threshold, out=self.changed)
+        np.copyto(self.previous, small)
+        self.level = float(np.count_nonzero(self.changed)) / self.changed.size
+        return self.level > self.fraction
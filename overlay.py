@@ -0,0 +1,182 @@
+import collections
+
+import numpy as np
+
+# Text overlay renderer. Each line is rasterised once into a small mask and
+# cached by its text and font parameters, the lines are composed into a
+# premultiplied colour and alpha tile that is kept from frame to frame and
+# only the tile's bounding region of the frame is blended, so the cost
+# depends on the text, not the sensor resolution.
+
+DEFAULT_TEMPLATE = ("{timestamp}\n"
+                    "EXP: {exposure:f} AG: {AnalogueGain:f} DG: {DigitalGain:f}\n"
+                    "TEMP: {SensorTemperature:f} LUX: {Lux:f} CT: {ColourTemperature:d} Focus: {FocusFoM:d}")
+
+POSITIONS = ("topleft", "topright", "bottomleft", "bottomright")
+
+# cv2.FONT_HERSHEY_SIMPLEX, cv2 itself is slow to import and only needed
+# once there is a line of text to rasterise
+FONT_HERSHEY_SIMPLEX = 0
+
+class Overlay:
+    def __init__(self, template=DEFAULT_TEMPLATE, position="topleft", scale=0.7, thickness=2,
+                 font=FONT_HERSHEY_SIMPLEX, foreground=(255, 255, 255), background=(0, 0, 0),
+                 opacity=1.0, cachesize=64):
+        if position not in POSITIONS:
+            raise ValueError("Unknown overlay position %s" % position)
+        self.template = template.split("\n") if template else []
+        self.position = position
+        self.scale = scale
+        self.thickness = thickness
+        self.font = font
+        self.foreground = np.array(foreground, np.float32)
+        self.background = np.array(background, np.float32)
+        self.opacity = opacity
+        self.cachesize = cachesize
+        self.linecache = collections.OrderedDict()
+        self.lastlines = None
+        self.channels = None
+        self.table = None
+        self.placed = None
+        self.premul = None
+
+    def format(self, dt, metadata):
+        fields = dict(metadata)
+        fields["timestamp"] = dt.isoformat()
+        if "ExposureTime" in metadata:
+            fields["exposure"] = metadata["ExposureTime"] / 1000000
+        lines = []
+        for line in self.template:
+            try:
+                lines.append(line.format_map(fields))
+            except (KeyError, ValueError):
+                # Field missing from this frame's metadata, leave the line out
+                continue
+        return lines
+
+    def render_line(self, text):
+        key = (text, self.font, self.scale, self.thickness)
+        cached = self.linecache.get(key)
+        if cached is not None:
+            self.linecache.move_to_end(key)
+            return cached
+        import cv2
+        (w, h), baseline = cv2.getTextSize(text, self.font, self.scale, self.thickness)
+        # Thick strokes spill outside the size getTextSize reports, so draw
+        # with a margin all round the box
+        pad = self.thickness + 2
+        mask = np.zeros((h + baseline + 4 + 2 * pad, w + 3 + 2 * pad), np.uint8)
+        cv2.putText(mask, text, (1 + pad, h + 2 + pad), self.font, self.scale, 255, self.thickness)
+        entry = (mask, pad, h, (h + baseline + 4, w + 3))
+        self.linecache[key] = entry
+        if len(self.linecache) > self.cachesize:
+            self.linecache.popitem(last=False)
+        return entry
+
+    def layout(self, lines):
+        # Lines are laid out as before, each baseline h+6 below the last with
+        # a box from 2px above the glyphs to 1px below the baseline, later
+        # lines drawn over earlier ones
+        placed = []
+        y = -2
+        for text in lines:
+            mask, pad, h, boxshape = self.render_line(text)
+            y += h + 6
+            placed.append((text, mask, pad, y - h - 2, boxshape))
+        return placed
+
+    def blend_table(self):
+        # Text coverage t over a box of opacity b over the frame:
+        #   out = fg*t + bg*b*(1-t) + frame*(1-b)*(1-t)
+        # kept as a premultiplied colour term and an inverse alpha, both
+        # scaled so blending is one integer multiply-add per pixel. There
+        # are only 256 coverages, in or out of a box, so both come from a
+        # table indexed by coverage + 256 * box. Channels of the frame past
+        # the colour's (the X of XBGR) are blended too, as whole pixels are
+        # much quicker to work on, but left as they are.
+        t = np.tile(np.arange(256, dtype=np.float32) / 255, 2)[:, None]
+        b = np.repeat(np.array([0, self.opacity], np.float32), 256)[:, None]
+        premul = (self.foreground * t + self.background * b * (1 - t)) * 255
+        inverse = (1 - b) * (1 - t) * 255
+        n = len(self.foreground)
+        table = np.zeros((512, self.channels), np.uint16), np.full((512, self.channels), 255, np.uint16)
+        table[0][:, :n] = np.rint(premul)
+        table[1][:, :n] = np.rint(inverse)
+        # Opaque pixels take the colour rounded down, not to nearest
+        opaque = table[1][:, 0] == 0
+        table[0][opaque] = table[0][opaque] // 255 * 255
+        return table
+
+    def compose(self, placed, r0, r1):
+        # Coverage and box of tile rows r0 to r1 from every line touching them
+        width = self.premul.shape[1]
+        text = np.zeros((r1 - r0, width), np.uint8)
+        box = np.zeros((r1 - r0, width), np.uint16)
+        for line, mask, pad, top, (bh, bw) in placed:
+            y0, y1 = max(top, r0), min(top + bh, r1)
+            if y0 < y1:
+                box[y0 - r0:y1 - r0, :bw] = 256
+                text[y0 - r0:y1 - r0, :bw] = 0
+            # The padded mask starts above and left of the box, clip it to
+            # the band and the tile, which starts at the frame edge
+            mt = top - pad
+            y0, y1 = max(mt, r0), min(mt + mask.shape[0], r1)
+            w = min(mask.shape[1] - pad, width)
+            if y0 < y1:
+                region = text[y0 - r0:y1 - r0, :w]
+                np.maximum(region, mask[y0 - mt:y1 - mt, pad:pad + w], out=region)
+        box += text
+        np.take(self.table[0], box, axis=0, out=self.premul[r0:r1])
+        np.take(self.table[1], box, axis=0, out=self.inverse[r0:r1])
+
+    def render(self, lines):
+        # The composed tile is kept and only the rows under lines that have
+        # changed are composed again, so a timestamp ticking over costs its
+        # own rows and nothing else. A change of size or layout redoes all.
+        placed = self.layout(lines)
+        height = max(top + mask.shape[0] - pad for line, mask, pad, top, boxshape in placed)
+        width = max(mask.shape[1] - pad for line, mask, pad, top, boxshape in placed)
+        old = self.placed
+        if self.table is None:
+            self.table = self.blend_table()
+        if old is None or len(old) != len(placed) or self.premul.shape[:2] != (height, width):
+            self.premul = np.empty((height, width, self.channels), np.uint16)
+            self.inverse = np.empty((height, width, self.channels), np.uint16)
+            self.scratch = np.empty((height, width, self.channels), np.uint16)
+            self.compose(placed, 0, height)
+        else:
+            rows = []
+            for a, b in zip(old, placed):
+                if a[0] != b[0] or a[3] != b[3]:
+                    for line, mask, pad, top, (bh, bw) in (a, b):
+                        rows += [top - pad, top + max(bh, mask.shape[0] - pad)]
+            if rows:
+                self.compose(placed, max(min(rows), 0), min(max(rows), height))
+        self.placed = placed
+
+    def apply(self, array, dt, metadata):
+        lines = self.format(dt, metadata)
+        if not lines:
+            return
+        if array.shape[2] != self.channels:
+            self.channels = array.shape[2]
+            self.table = None
+            self.placed = None
+            self.lastlines = None
+        if lines != self.lastlines:
+            self.render(lines)
+            self.lastlines = lines
+
+        fh, fw = array.shape[:2]
+        th, tw = min(self.premul.shape[0], fh), min(self.premul.shape[1], fw)
+        y0 = 0 if self.position.startswith("top") else fh - th
+        x0 = 0 if self.position.endswith("left") else fw - tw
+        region = array[y0:y0 + th, x0:x0 + tw]
+        # Every pixel of the tile in one pass, ones outside the boxes and
+        # text have an inverse alpha of 255 and come back unchanged
+        blended = self.scratch[:th, :tw]
+        np.multiply(region, self.inverse[:th, :tw], out=blended)
+        blended += self.premul[:th, :tw]
+        blended += 127
+        blended //= 255
+        np.copyto(region, blended, casting="unsafe")
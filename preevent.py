@@ -0,0 +1,121 @@
+import os
+import time
+import queue
+import datetime
+import threading
+import collections
+
+# Pre-event recording. Encoded frames are kept in memory, bounded by bytes
+# and always starting at a keyframe, and only written out when trigger() is
+# called: from the last keyframe at least preroll seconds back, then live
+# until postroll seconds after the last trigger. Used as the output of the
+# H.264 encoder, in place of writing every frame to disk. The encoder needs
+# to repeat its SPS/PPS headers on every keyframe so a clip can start at any.
+
+class PreEventOutput:
+    def __init__(self, maxbytes=32 * 1024 * 1024, preroll=5.0, postroll=10.0, filename="imgs/%Y%m%dT%H%M%S.h264"):
+        self.maxbytes = maxbytes
+        self.preroll = preroll
+        self.postroll = postroll
+        self.filename = filename
+        self.frames = collections.deque()
+        self.bytes = 0
+        self.until = None
+        self.waitkey = False
+        self.lock = threading.Lock()
+        # Files are written on their own thread so the encoder never waits
+        # on the disk
+        self.queue = queue.Queue()
+        self.clips = 0
+        self.written = 0
+        threading.Thread(target=self.writer, daemon=True).start()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        with self.lock:
+            if self.until is not None:
+                self.queue.put(("close",))
+                self.until = None
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, packet=None, audio=False):
+        if audio:
+            return
+        # The encoder may reuse the buffer it passes
+        frame = bytes(frame)
+        now = time.monotonic()
+        with self.lock:
+            self.frames.append((now, keyframe, frame))
+            self.bytes += len(frame)
+            self.trim()
+            if self.until is not None:
+                if now > self.until:
+                    self.queue.put(("close",))
+                    self.until = None
+                elif self.waitkey and not keyframe:
+                    pass
+                else:
+                    self.waitkey = False
+                    self.queue.put(("write", frame))
+
+    def trim(self):
+        # Drop the oldest frames over the byte limit, then up to the next
+        # keyframe so the buffer can always be played from its start
+        if self.bytes <= self.maxbytes:
+            return
+        while self.frames and self.bytes > self.maxbytes:
+            self.bytes -= len(self.frames.popleft()[2])
+        while self.frames and not self.frames[0][1]:
+            self.bytes -= len(self.frames.popleft()[2])
+
+    def trigger(self):
+        # Starts a clip, or extends the one being written
+        now = time.monotonic()
+        with self.lock:
+            if self.until is None:
+                frames = list(self.frames)
+                start = None
+                for i in range(len(frames) - 1, -1, -1):
+                    t, keyframe, frame = frames[i]
+                    if keyframe:
+                        start = i
+                        if t <= now - self.preroll:
+                            break
+                self.queue.put(("open", datetime.datetime.utcnow().strftime(self.filename)))
+                if start is None:
+                    self.waitkey = True
+                else:
+                    self.waitkey = False
+                    for t, keyframe, frame in frames[start:]:
+                        self.queue.put(("write", frame))
+                self.clips += 1
+            self.until = now + self.postroll
+
+    def recording(self):
+        return self.until is not None
+
+    def writer(self):
+        f = None
+        while True:
+            op = self.queue.get()
+            if op[0] == "open":
+                if f is not None:
+                    f.close()
+                if os.path.dirname(op[1]):
+                    os.makedirs(os.path.dirname(op[1]), exist_ok=True)
+                f = open(op[1], "wb")
+            elif op[0] == "write" and f is not None:
+                f.write(op[1])
+                self.written += len(op[1])
+            elif op[0] == "close" and f is not None:
+                f.close()
+                f = None
+
+    def add_metrics(self, registry):
+        registry.gauge("preevent_buffered_bytes", "Encoded video held in memory", fn=lambda: self.bytes)
+        registry.gauge("preevent_buffered_seconds", "Span of encoded video held in memory",
+                       fn=lambda: self.frames[-1][0] - self.frames[0][0] if len(self.frames) > 1 else 0.0)
+        registry.counter("preevent_clips_total", "Clips started", fn=lambda: self.clips)
+        registry.counter("preevent_written_bytes_total", "Encoded video written to clips", fn=lambda: self.written)
+        registry.gauge("preevent_recording", "Whether a clip is being written", fn=lambda: int(self.recording()))
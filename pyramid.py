@@ -0,0 +1,72 @@
+import numpy as np
+import simplejpeg
+
+from framesource import yuv420_planes
+
+# Area averaged 2:1 downscaling, each output pixel the rounded mean of a 2x2
+# block, so a chain of halvings gives a pyramid of renditions at a fraction
+# of the cost of resizing the full frame for each one.
+
+class Halver:
+    # Halves (h, w) or (h, w, channels) uint8 arrays of one shape into a
+    # buffer it owns, an odd last row or column is dropped. Rows are summed
+    # first while they are contiguous, then column pairs.
+    def __init__(self, shape):
+        h, w = shape[0] // 2, shape[1] // 2
+        rest = tuple(shape[2:])
+        self.rows = np.empty((h, w * 2) + rest, np.uint16)
+        self.acc = np.empty((h, w) + rest, np.uint16)
+        self.out = np.empty((h, w) + rest, np.uint8)
+
+    def __call__(self, src):
+        h, w = self.out.shape[:2]
+        np.add(src[0:2 * h:2, :2 * w], src[1:2 * h:2, :2 * w], out=self.rows, dtype=np.uint16)
+        np.add(self.rows[:, 0::2], self.rows[:, 1::2], out=self.acc)
+        self.acc += 2
+        self.acc >>= 2
+        np.copyto(self.out, self.acc, casting="unsafe")
+        return self.out
+
+def halve(src):
+    return Halver(src.shape)(src).copy()
+
+
+COLORSPACES = {"XBGR8888": "RGBX", "XRGB8888": "BGRX"}
+
+class Pyramid:
+    # Renditions of a camera stream at successive halvings. format is the
+    # stream's pixel format, YUV420 (each plane halved separately) or one of
+    # the 32 bit RGB formats. The halving buffers are reused, so a level
+    # must be encoded before the next frame is built.
+    def __init__(self, format):
+        self.yuv = format == "YUV420"
+        self.colorspace = COLORSPACES.get(format)
+        self.halvers = {}
+
+    def halver(self, key, array):
+        halver = self.halvers.get(key)
+        if halver is None or halver.out.shape[:2] != (array.shape[0] // 2, array.shape[1] // 2):
+            halver = self.halvers[key] = Halver(array.shape)
+        return halver
+
+    def build(self, array, levels):
+        # Returns {level: planes} for each level wanted. Level 0 is copied,
+        # the rest come from one chain of halvings stopping at the deepest
+        # level wanted, which read straight from array.
+        planes = yuv420_planes(array) if self.yuv else (array,)
+        out = {}
+        for level in range(max(levels) + 1):
+            if level in levels:
+                out[level] = tuple(p.copy() for p in planes) if level == 0 else planes
+            if level < max(levels):
+                planes = tuple(self.halver((i, level), p)(p) for i, p in enumerate(planes))
+        return out
+
+    def encode(self, planes, quality):
+        if self.yuv:
+            y, u, v = planes
+            # Odd sizes lose a row or column halving the chroma, keep luma
+            # exactly twice the chroma size
+            y = np.ascontiguousarray(y[:2 * u.shape[0], :2 * u.shape[1]])
+            return simplejpeg.encode_jpeg_yuv_planes(y, u, v, quality=quality)
+        return simplejpeg.encode_jpeg(planes[0], quality=quality, colorspace=self.colorspace, colorsubsampling="420")
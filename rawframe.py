@@ -0,0 +1,118 @@
+import os
+
+import numpy as np
+
+# Raw Bayer frames for stacking. The camera's unpacked raw formats (e.g.
+# SRGGB12, SRGGB16) hold each sample in 16 bits, so a frame is saved as a
+# (h, w) uint16 array, either .npy or FITS, both of which np.memmap can
+# read straight from the page cache without decoding anything.
+
+EXTENSIONS = {"npy": ".npy", "fits": ".fits"}
+
+def bayer_view(array, width):
+    # The camera hands unpacked raw buffers over as (h, stride) bytes, view
+    # them as 16 bit samples and drop the row padding
+    return array.view(np.uint16)[:, :width]
+
+def raw_format_info(format):
+    # "SRGGB12" -> ("RGGB", 12)
+    return format[1:5], int(format[5:7])
+
+def is_fits(filename):
+    return os.path.splitext(filename)[1].lower() in (".fit", ".fits", ".fts")
+
+# FITS: 2880 byte blocks of 80 character header cards, then big endian
+# data. Unsigned 16 bit data is stored signed with BZERO = 32768.
+
+BITPIX = {np.dtype(np.uint8): 8, np.dtype(np.uint16): 16, np.dtype(np.float32): -32}
+DTYPES = {8: ">u1", 16: ">i2", 32: ">i4", -32: ">f4", -64: ">f8"}
+
+def fits_card(key, value, comment=None):
+    if isinstance(value, bool):
+        value = "T" if value else "F"
+    elif isinstance(value, str):
+        value = "'%-8s'" % value.replace("'", "''")
+    else:
+        value = repr(value)
+    card = "%-8s= %20s" % (key, value)
+    if comment:
+        card += " / " + comment
+    return "%-80s" % card[:80]
+
+def write_fits(filename, array, header=None):
+    # 2D (mono or Bayer) or (h, w, 3) uint8, uint16 or float32 images
+    if array.dtype not in BITPIX:
+        raise ValueError("Can't write %s images to FITS" % array.dtype)
+    if array.ndim == 3:
+        # FITS axes are planes of the image, not interleaved samples
+        array = np.moveaxis(array, 2, 0)
+    cards = [fits_card("SIMPLE", True), fits_card("BITPIX", BITPIX[array.dtype]),
+             fits_card("NAXIS", array.ndim)]
+    for i, n in enumerate(reversed(array.shape)):
+        cards.append(fits_card("NAXIS%d" % (i + 1), n))
+    if array.dtype == np.uint16:
+        cards += [fits_card("BZERO", 32768), fits_card("BSCALE", 1)]
+    for key, value in (header or {}).items():
+        cards.append(fits_card(key, value))
+    cards.append("%-80s" % "END")
+    head = "".join(cards).encode("ascii")
+
+    if array.dtype == np.uint16:
+        data = np.bitwise_xor(array, 0x8000, dtype=np.uint16).astype(">u2").view(">i2")
+    else:
+        data = array.astype(array.dtype.newbyteorder(">"))
+    tmpname = filename + ".new"
+    with open(tmpname, "wb") as f:
+        f.write(head + b" " * (-len(head) % 2880))
+        f.write(data.tobytes())
+        f.write(b"\0" * (-data.nbytes % 2880))
+    os.rename(tmpname, filename)
+
+def read_fits_header(f):
+    header = {}
+    length = 0
+    while True:
+        block = f.read(2880)
+        if len(block) < 2880:
+            raise ValueError("Truncated FITS header")
+        length += 2880
+        for i in range(0, 2880, 80):
+            card = block[i:i + 80].decode("ascii")
+            key = card[:8].strip()
+            if key == "END":
+                return header, length
+            if card[8:10] != "= ":
+                continue
+            value = card[10:].strip()
+            if value.startswith("'"):
+                # Quotes inside strings are doubled
+                end = 1
+                while True:
+                    end = value.index("'", end)
+                    if value[end + 1:end + 2] != "'":
+                        break
+                    end += 2
+                header[key] = value[1:end].replace("''", "'").rstrip()
+                continue
+            value = value.split("/")[0].strip()
+            if value in ("T", "F"):
+                header[key] = value == "T"
+            elif any(c in value.upper() for c in ".ED"):
+                header[key] = float(value.upper().replace("D", "E"))
+            else:
+                header[key] = int(value)
+
+def read_fits(filename):
+    # Primary image as a memmap where the stored values are the pixel values,
+    # unsigned 16 bit data is converted in one pass
+    with open(filename, "rb") as f:
+        header, offset = read_fits_header(f)
+    shape = tuple(header["NAXIS%d" % (i + 1)] for i in range(header["NAXIS"]))[::-1]
+    data = np.memmap(filename, DTYPES[header["BITPIX"]], "r", offset=offset, shape=shape)
+    if header.get("BZERO", 0) == 32768 and header["BITPIX"] == 16:
+        data = np.bitwise_xor(data.view(">u2"), 0x8000, dtype=np.uint16)
+    elif header.get("BZERO", 0) or header.get("BSCALE", 1) != 1:
+        data = data * header.get("BSCALE", 1) + header.get("BZERO", 0)
+    if data.ndim == 3:
+        data = np.moveaxis(data, 0, 2)
+    return data
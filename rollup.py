@@ -0,0 +1,295 @@
+#!/usr/bin/python3
+import os
+import time
+import glob
+import json
+import datetime
+import argparse
+import subprocess
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import simplejpeg
+from PIL import Image
+
+# Daily keogram, contact sheet and video from a timelapse.py archive. Frames
+# are taken in capture order from the day's metadata log (or the directory
+# when there is none), decoded a few at a time on worker threads, and each
+# one is decoded straight to the smallest DCT scale (1/8 to 1) big enough for
+# what it is used for. Only the outputs are held in memory, growing as
+# frames arrive, and they are rewritten as the day goes on with --follow.
+
+class GrowingArray:
+    # (h, n, 3) image that gains a column, or (n, w, 3) a row, at a time.
+    # Capacity doubles so appending stays cheap.
+    def __init__(self, axis):
+        self.axis = axis
+        self.buf = None
+        self.n = 0
+
+    def append(self, block):
+        size = block.shape[self.axis]
+        if self.buf is None:
+            shape = list(block.shape)
+            shape[self.axis] = max(size, 64)
+            self.buf = np.zeros(shape, np.uint8)
+        elif self.n + size > self.buf.shape[self.axis]:
+            shape = list(self.buf.shape)
+            shape[self.axis] = max(2 * shape[self.axis], self.n + size)
+            buf = np.zeros(shape, np.uint8)
+            index = [slice(None)] * 3
+            index[self.axis] = slice(0, self.n)
+            buf[tuple(index)] = self.buf[tuple(index)]
+            self.buf = buf
+        index = [slice(None)] * 3
+        index[self.axis] = slice(self.n, self.n + size)
+        self.buf[tuple(index)] = block
+        self.n += size
+
+    def array(self):
+        index = [slice(None)] * 3
+        index[self.axis] = slice(0, self.n)
+        return self.buf[tuple(index)]
+
+class Keogram:
+    # The centre column of every frame, one pixel wide, left to right, at
+    # 1/scale of the height of the first frame
+    def __init__(self, scale):
+        self.scale = scale
+        self.height = None
+        self.columns = GrowingArray(1)
+
+    def add(self, frame, fullheight):
+        if self.height is None:
+            self.height = -(-fullheight // self.scale)
+        h, w = frame.shape[:2]
+        rows = np.arange(self.height) * h // self.height
+        self.columns.append(frame[rows, w // 2][:, None])
+
+    def image(self):
+        return self.columns.array() if self.columns.n else None
+
+class ContactSheet:
+    # Thumbnails in rows of columns, one every interval seconds
+    def __init__(self, width, columns, interval):
+        self.width = width
+        self.columns = columns
+        self.interval = interval
+        self.height = None
+        self.rows = GrowingArray(0)
+        self.row = None
+        self.count = 0
+        self.last = None
+
+    def due(self, t):
+        return self.last is None or t is None or (t - self.last).total_seconds() >= self.interval
+
+    def add(self, frame, t):
+        self.last = t
+        if self.height is None:
+            self.height = max(1, round(self.width * frame.shape[0] / frame.shape[1]))
+            self.row = np.zeros((self.height, self.width * self.columns, 3), np.uint8)
+        thumb = np.asarray(Image.fromarray(frame).resize((self.width, self.height), Image.BOX))
+        i = self.count % self.columns
+        self.row[:, i * self.width:(i + 1) * self.width] = thumb
+        self.count += 1
+        if i == self.columns - 1:
+            self.rows.append(self.row)
+            self.row[:] = 0
+
+    def image(self):
+        if self.count == 0:
+            return None
+        if self.count % self.columns == 0:
+            return self.rows.array()
+        # The part filled row goes on the end of the saved image only
+        if self.rows.n == 0:
+            return self.row
+        return np.concatenate((self.rows.array(), self.row))
+
+def save_jpeg(filename, image, quality):
+    if image is None:
+        return
+    with open(filename + ".new", "wb") as f:
+        f.write(simplejpeg.encode_jpeg(np.ascontiguousarray(image), quality=quality, colorspace="RGB"))
+    os.rename(filename + ".new", filename)
+
+
+def log_names(logname, follow, poll, done):
+    # Names from the metadata log as they are appended, None whenever it has
+    # been read to the end so the caller can catch up
+    offset = 0
+    while True:
+        if os.path.exists(logname):
+            with open(logname, "rb") as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # Still being written
+                        break
+                    offset += len(line)
+                    try:
+                        name = json.loads(line)["name"]
+                    except ValueError:
+                        continue
+                    yield name
+        yield None
+        if not follow or done():
+            return
+        time.sleep(poll)
+
+def dir_names(daydir, ext, follow, poll, done):
+    # Without a metadata log, names in order from the directory
+    last = ""
+    while True:
+        names = sorted(os.path.basename(p) for p in glob.glob(os.path.join(glob.escape(daydir), "*" + ext)))
+        for name in names:
+            if name > last:
+                last = name
+                yield name
+        yield None
+        if not follow or done():
+            return
+        time.sleep(poll)
+
+def decoded(names, decode, workers, depth):
+    # Decodes ahead of the caller on a pool, at most depth frames in flight
+    # so memory doesn't grow with the day. None (caught up) is passed through
+    # once everything before it has been handed over.
+    with ThreadPoolExecutor(workers) as pool:
+        pending = collections.deque()
+        for name in names:
+            if name is None:
+                while pending:
+                    yield pending.popleft().result()
+                yield None
+                continue
+            pending.append(pool.submit(decode, name))
+            if len(pending) >= depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Keogram, contact sheet and video for a day of timelapse images', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--date', type=str, default=None, help='Day to roll up, YYYY-MM-DD in UTC like the archive, defaults to today')
+    parser.add_argument('--dirname', type=str, default="imgs/", help='Archive directory, as for timelapse.py')
+    parser.add_argument('--filename', type=str, default="%Y/%m/%d/%Y%m%dT%H%M%S.jpg", help='Filename template the archive was written with')
+    parser.add_argument('--metadata', type=str, default="%Y/%m/%d/metadata.jsonl", help='Metadata log template, the directory is listed instead if the log is missing')
+    parser.add_argument('--output', type=str, default=None, help='Directory for the outputs, defaults to the day\'s directory')
+    parser.add_argument('--keogram', type=str, default="keogram.jpg", help='Keogram filename, empty for none')
+    parser.add_argument('--scale', type=int, default=4, choices=(1, 2, 4, 8), help='Keogram height as a fraction of the frame height, frames are decoded at this scale')
+    parser.add_argument('--sheet', type=str, default="contact.jpg", help='Contact sheet filename, empty for none')
+    parser.add_argument('--thumbwidth', type=int, default=240, help='Contact sheet thumbnail width')
+    parser.add_argument('--columns', type=int, default=8, help='Contact sheet thumbnails per row')
+    parser.add_argument('--sheetinterval', type=float, default=600, help='Seconds between contact sheet thumbnails')
+    parser.add_argument('--video', type=str, default="", help='Video filename (with ffmpeg), empty for none')
+    parser.add_argument('--videofps', type=float, default=25, help='Video frame rate')
+    parser.add_argument('--ffmpeg', type=str, default="ffmpeg", help='ffmpeg command')
+    parser.add_argument('--quality', type=int, default=90, help='JPEG quality of the keogram and contact sheet')
+    parser.add_argument('--workers', type=int, default=2, help='Decode threads')
+    parser.add_argument('--depth', type=int, default=8, help='Most frames read or decoded ahead')
+    parser.add_argument('--follow', default=False, action='store_true', help='Keep adding frames as they are captured until the day is over')
+    parser.add_argument('--poll', type=float, default=30, help='Seconds between checks for new frames with --follow')
+    parser.add_argument('--updateevery', type=int, default=100, help='Frames between rewrites of the keogram and contact sheet')
+    args = parser.parse_args()
+
+    if args.date is None:
+        day = datetime.datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    else:
+        day = datetime.datetime.strptime(args.date, "%Y-%m-%d")
+    daydir = os.path.join(args.dirname, os.path.dirname(day.strftime(args.filename)))
+    nametemplate = os.path.basename(args.filename)
+    ext = os.path.splitext(nametemplate)[1]
+    output = args.output or daydir
+    os.makedirs(output, exist_ok=True)
+
+    def done():
+        return datetime.datetime.utcnow() >= day + datetime.timedelta(days=1)
+
+    logname = os.path.join(args.dirname, day.strftime(args.metadata)) if args.metadata else None
+    if logname is not None and (os.path.exists(logname) or args.follow):
+        names = log_names(logname, args.follow, args.poll, done)
+    else:
+        names = dir_names(daydir, ext, args.follow, args.poll, done)
+
+    keogram = Keogram(args.scale) if args.keogram else None
+    sheet = ContactSheet(args.thumbwidth, args.columns, args.sheetinterval) if args.sheet else None
+
+    video = None
+    if args.video:
+        # The JPEGs are passed through untouched, ffmpeg decodes them itself
+        video = subprocess.Popen([args.ffmpeg, "-loglevel", "error", "-y", "-f", "image2pipe", "-c:v", "mjpeg",
+                                  "-framerate", str(args.videofps), "-i", "-", "-c:v", "libx264", "-pix_fmt", "yuv420p",
+                                  "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2", os.path.join(output, args.video)],
+                                 stdin=subprocess.PIPE)
+
+    def timestamp(name):
+        try:
+            return datetime.datetime.strptime(name, nametemplate)
+        except ValueError:
+            return None
+
+    def decode(name):
+        # Reads and decodes one frame at the smallest scale the keogram and
+        # (if it is due one) the contact sheet need, t is the capture time
+        t = timestamp(name)
+        try:
+            with open(os.path.join(daydir, name), "rb") as f:
+                data = f.read()
+            h, w = simplejpeg.decode_jpeg_header(data)[:2]
+            minheight = -(-h // args.scale) if keogram is not None else 0
+            minwidth = args.thumbwidth if sheet is not None and sheet.due(t) else 0
+            frame = None
+            if minheight or minwidth:
+                frame = simplejpeg.decode_jpeg(data, colorspace="RGB", min_height=minheight, min_width=minwidth)
+        except (OSError, ValueError) as e:
+            return name, t, e
+        return name, t, (h, data if video is not None else None, frame, minwidth > 0)
+
+    def save():
+        if keogram is not None:
+            save_jpeg(os.path.join(output, args.keogram), keogram.image(), args.quality)
+        if sheet is not None:
+            save_jpeg(os.path.join(output, args.sheet), sheet.image(), args.quality)
+
+    count = 0
+    saved = 0
+    # Only names the template parses, not the outputs written alongside them
+    frames = (n for n in names if n is None or timestamp(n) is not None)
+    for item in decoded(frames, decode, args.workers, args.depth):
+        if item is None:
+            if count > saved:
+                save()
+                saved = count
+                print("%d frames" % count)
+            continue
+        name, t, result = item
+        if isinstance(result, Exception):
+            print("Skipping %s: %s" % (name, result))
+            continue
+        h, data, frame, thumb = result
+        if keogram is not None:
+            keogram.add(frame, h)
+        # Decoding ran ahead, the sheet may have taken a thumbnail since this
+        # frame was checked
+        if thumb and sheet.due(t):
+            sheet.add(frame, t)
+        if video is not None:
+            video.stdin.write(data)
+        count += 1
+        if count - saved >= args.updateevery:
+            save()
+            saved = count
+
+    save()
+    if video is not None:
+        video.stdin.close()
+        video.wait()
+    print("Rolled up %d frames from %s" % (count, daydir))
+
+
+if __name__ == "__main__":
+    main()
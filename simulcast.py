@@ -0,0 +1,72 @@
+import os
+
+from broadcast import FrameBroadcast
+from pyramid import Pyramid
+
+# Several renditions of one camera stream, each half the size of the one
+# before, built from the same buffer by a single chain of area averaged
+# halvings. Only renditions somebody is watching are built and encoded. The
+# object is itself a stream selector for streaming.serve, picking a
+# rendition by the ?w= width in the query string.
+
+class Rendition:
+    def __init__(self, level, size):
+        self.level = level
+        self.size = size
+        self.output = FrameBroadcast()
+
+class Simulcast:
+    def __init__(self, format, size, levels=2, quality=80, minwidth=160):
+        self.pyramid = Pyramid(format)
+        self.quality = quality
+        self.renditions = []
+        w, h = size
+        for level in range(levels + 1):
+            if level and w < minwidth:
+                break
+            self.renditions.append(Rendition(level, (w, h)))
+            w, h = w // 2, h // 2
+        self.levels = set()
+        self.pending = {}
+
+    def __call__(self, params):
+        # The smallest rendition at least w wide, or the largest if w is
+        # wider than all of them
+        if 'w' not in params:
+            return self.renditions[0].output
+        try:
+            width = int(params['w'][0])
+        except ValueError:
+            raise ValueError("w must be a width in pixels")
+        fits = [r for r in self.renditions if r.size[0] >= width]
+        return (fits[-1] if fits else self.renditions[0]).output
+
+    def streams(self, path):
+        # path itself with the ?w= selector, plus each rendition at
+        # e.g. /stream_640.mjpg
+        base, ext = os.path.splitext(path)
+        streams = {path: self}
+        for r in self.renditions:
+            streams['%s_%d%s' % (base, r.size[0], ext)] = r.output
+        return streams
+
+    def outputs(self):
+        return [r.output for r in self.renditions]
+
+    def wanted(self, now=None):
+        self.levels = {r.level for r in self.renditions if r.output.has_subscribers()}
+        return bool(self.levels)
+
+    def secure(self, array):
+        self.pending = self.pyramid.build(array, self.levels)
+
+    def encode(self):
+        for r in self.renditions:
+            planes = self.pending.get(r.level)
+            if planes is not None:
+                r.output.write(self.pyramid.encode(planes, self.quality))
+        self.pending = {}
+
+def add_simulcast_arguments(parser):
+    parser.add_argument('--simulcast', type=int, default=0, help='Also serve the stream at up to this many halvings of its resolution, chosen with ?w= or at /stream_WIDTH.mjpg (software encoded)')
+    parser.add_argument('--simulcastquality', type=int, default=80, help='JPEG quality of simulcast renditions')
@@ -1,38 +1,429 @@
 from optparse import OptionParser
+import json
+from multiprocessing import Pool, shared_memory
+import os
 from PIL import Image
 import numpy as np
 
+import rawframe
+
+try:
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+MODES = ("max", "mean", "median", "sigma")
+
+# Accumulator layout for each mode, (name, dtype), None means same dtype as
+# the input frames. Everything is allocated once up front and updated in place.
+# Sums are float64 as float32 stops counting exactly past 2**24, a few
+# thousand 12 bit frames.
+BUFFERS = {"max": (("acc", None),),
+           "mean": (("sum", np.float64),),
+           "median": (("median", np.float32),),
+           "sigma": (("mean", np.float32),
+                     ("m2", np.float32),
+                     ("sum", np.float64),
+                     ("n", np.uint32))}
+
+class Stacker:
+    def __init__(self, mode, shape, dtype, kappa=3.0, warmup=5, alloc=None, maxval=None, stepmax=None):
+        if mode not in MODES:
+            raise ValueError("Unknown stacking mode %s" % mode)
+        if alloc is None:
+            alloc = lambda name, shape, dtype: np.zeros(shape, dtype)
+
+        self.mode = mode
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.kappa = kappa
+        self.warmup = warmup
+        self.count = 0
+        self.buffers = {}
+        for name, bdtype in BUFFERS[mode]:
+            self.buffers[name] = alloc(name, self.shape, self.dtype if bdtype is None else bdtype)
+        # Scratch space so per-frame updates never allocate
+        if mode != "max":
+            self.tmp = np.empty(self.shape, np.float32)
+            self.tmp2 = np.empty(self.shape, np.float32)
+        if mode == "sigma":
+            self.mask = np.empty(self.shape, np.bool_)
+
+        # The range of the data, which can be less than the dtype's, e.g. 12
+        # bit raw samples in uint16
+        if maxval is not None:
+            self.maxval = maxval
+        elif np.issubdtype(self.dtype, np.integer):
+            self.maxval = np.iinfo(self.dtype).max
+        else:
+            self.maxval = 1.0
+        # What the median steps are sized for, which can be a guess at the
+        # range as it is never used to clip
+        self.stepmax = self.maxval if stepmax is None else stepmax
+
+    def add(self, frame):
+        if frame.shape != self.shape:
+            raise ValueError("Frame shape %s does not match stack shape %s" % (frame.shape, self.shape))
+        self.count += 1
+        getattr(self, "_add_" + self.mode)(frame)
+
+    def _add_max(self, frame):
+        acc = self.buffers["acc"]
+        if self.count == 1:
+            np.copyto(acc, frame)
+        else:
+            np.maximum(acc, frame, out=acc)
+
+    def _add_mean(self, frame):
+        s = self.buffers["sum"]
+        np.add(s, frame, out=s, casting="unsafe")
+
+    def _add_median(self, frame):
+        # Frugal streaming median, each pixel steps towards the new sample by
+        # a step size that decays as more frames arrive, from a sizeable
+        # fraction of the range to one count of the data after 256 frames
+        # (for 8 and 12 bit data, longer for more bits)
+        est = self.buffers["median"]
+        if self.count == 1:
+            np.copyto(est, frame, casting="unsafe")
+            return
+        scale = self.stepmax / 255.0
+        step = max(1.0, 16.0 / np.sqrt(self.count)) * max(1.0, scale / np.sqrt(self.count))
+        np.subtract(frame, est, out=self.tmp, casting="unsafe")
+        np.sign(self.tmp, out=self.tmp)
+        self.tmp *= step
+        est += self.tmp
+
+    def _add_sigma(self, frame):
+        # Welford running mean/variance over every frame, plus a sum and count
+        # of the samples within kappa sigma of the running mean at the time
+        # they arrived
+        mean = self.buffers["mean"]
+        m2 = self.buffers["m2"]
+        s = self.buffers["sum"]
+        n = self.buffers["n"]
+        delta = self.tmp
+        np.subtract(frame, mean, out=delta, casting="unsafe")
+
+        if self.count > self.warmup:
+            np.divide(m2, self.count - 2, out=self.tmp2)
+            np.sqrt(self.tmp2, out=self.tmp2)
+            self.tmp2 *= self.kappa
+            np.abs(delta, out=delta)
+            np.less_equal(delta, self.tmp2, out=self.mask)
+            np.subtract(frame, mean, out=delta, casting="unsafe")
+        else:
+            self.mask.fill(True)
+        np.add(s, frame, out=s, where=self.mask, casting="unsafe")
+        np.add(n, 1, out=n, where=self.mask, casting="unsafe")
+
+        mean += np.divide(delta, self.count, out=self.tmp2)
+        np.subtract(frame, mean, out=self.tmp2, casting="unsafe")
+        self.tmp2 *= delta
+        m2 += self.tmp2
+
+    def merge(self, other):
+        # Fold another partial stack of the same shape into this one
+        if other.mode != self.mode or other.shape != self.shape:
+            raise ValueError("Cannot merge %s stack of %s into %s stack of %s" % (other.mode, other.shape, self.mode, self.shape))
+        if self.mode == "sigma" and other.kappa != self.kappa:
+            raise ValueError("Cannot merge kappa %g stack into kappa %g stack" % (other.kappa, self.kappa))
+        if other.count == 0:
+            return
+        if self.count == 0:
+            for name, buf in self.buffers.items():
+                np.copyto(buf, other.buffers[name])
+            self.count = other.count
+            return
+
+        count = self.count + other.count
+        if self.mode == "max":
+            np.maximum(self.buffers["acc"], other.buffers["acc"], out=self.buffers["acc"])
+        elif self.mode == "mean":
+            self.buffers["sum"] += other.buffers["sum"]
+        elif self.mode == "median":
+            # No exact merge for the streaming estimate, weight by frame count
+            est = self.buffers["median"]
+            est *= self.count / count
+            np.multiply(other.buffers["median"], other.count / count, out=self.tmp)
+            est += self.tmp
+        elif self.mode == "sigma":
+            # Chan et al. pairwise combination of the Welford statistics
+            mean = self.buffers["mean"]
+            m2 = self.buffers["m2"]
+            np.subtract(other.buffers["mean"], mean, out=self.tmp)
+            np.multiply(self.tmp, other.count / count, out=self.tmp2)
+            mean += self.tmp2
+            np.square(self.tmp, out=self.tmp)
+            self.tmp *= self.count * other.count / count
+            m2 += self.tmp
+            m2 += other.buffers["m2"]
+            self.buffers["sum"] += other.buffers["sum"]
+            self.buffers["n"] += other.buffers["n"]
+        self.count = count
+
+    def result(self):
+        if self.count == 0:
+            raise ValueError("No frames stacked")
+        if self.mode == "max":
+            return self.buffers["acc"].copy()
+        if self.mode == "mean":
+            np.divide(self.buffers["sum"], self.count, out=self.tmp)
+        elif self.mode == "median":
+            np.copyto(self.tmp, self.buffers["median"])
+        elif self.mode == "sigma":
+            n = self.buffers["n"]
+            np.divide(self.buffers["sum"], n, out=self.tmp, where=n > 0)
+            np.copyto(self.tmp, self.buffers["mean"], where=n == 0)
+        if np.issubdtype(self.dtype, np.integer):
+            np.rint(self.tmp, out=self.tmp)
+            np.clip(self.tmp, 0, self.maxval, out=self.tmp)
+        return self.tmp.astype(self.dtype)
+
+
+def load(filename):
+    # Raw frames are memory mapped, the stackers read them straight from the
+    # page cache
+    if os.path.splitext(filename)[1].lower() == ".npy":
+        return np.load(filename, mmap_mode="r")
+    if rawframe.is_fits(filename):
+        return rawframe.read_fits(filename)
+
+    if simplejpeg is not None and os.path.splitext(filename)[1].lower() in (".jpg", ".jpeg"):
+        with open(filename, "rb") as f:
+            data = f.read()
+        if simplejpeg.decode_jpeg_header(data)[2] == "Gray":
+            return simplejpeg.decode_jpeg(data, colorspace="Gray")[:, :, 0]
+        return simplejpeg.decode_jpeg(data, colorspace="RGB")
+
+    with Image.open(filename) as img:
+        return np.asarray(img)
+
+def data_maxval(filename, frame, bitdepth=None):
+    # (maxval, stepmax), the largest value the frames can hold and the one
+    # the median steps are sized for. Raw frames are stored in uint16
+    # whatever the sensor's bit depth, which FITS frames record in BITDEPTH.
+    # Otherwise the result is only clipped to the dtype's range, and the
+    # steps are sized for the smallest sensor depth that holds the first
+    # frame.
+    if bitdepth is None and rawframe.is_fits(filename):
+        with open(filename, "rb") as f:
+            bitdepth = rawframe.read_fits_header(f)[0].get("BITDEPTH")
+    if bitdepth is not None:
+        return (1 << bitdepth) - 1, None
+    if frame.dtype == np.uint16:
+        top = int(frame.max())
+        return None, (1 << next(b for b in (10, 12, 14, 16) if top < 1 << b)) - 1
+    return None, None
+
+def shm_alloc(blocks):
+    def alloc(name, shape, dtype):
+        return np.ndarray(shape, dtype, buffer=blocks[name].buf)
+    return alloc
+
+def stack_worker(filenames, mode, shape, dtype, kappa, maxval, stepmax, shmnames):
+    # Runs in a pool process, stacks its share of the files straight into
+    # the shared memory accumulators created by the parent
+    blocks = {}
+    for name, shmname in shmnames.items():
+        blocks[name] = shared_memory.SharedMemory(name=shmname)
+    stacker = Stacker(mode, shape, dtype, kappa=kappa, alloc=shm_alloc(blocks), maxval=maxval, stepmax=stepmax)
+    for filename in filenames:
+        stacker.add(load(filename))
+    count = stacker.count
+    del stacker
+    for block in blocks.values():
+        block.close()
+    return count
+
+def parallel_stack(filenames, jobs, mode, kappa, bitdepth=None):
+    first = load(filenames[0])
+    shape, dtype = first.shape, first.dtype
+    maxval, stepmax = data_maxval(filenames[0], first, bitdepth)
+    del first
+
+    blocks = []
+    try:
+        for i in range(jobs):
+            worker_blocks = {}
+            for name, bdtype in BUFFERS[mode]:
+                nbytes = int(np.prod(shape)) * np.dtype(dtype if bdtype is None else bdtype).itemsize
+                # Fresh blocks are zero filled, which is what the accumulators expect
+                worker_blocks[name] = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+            blocks.append(worker_blocks)
+
+        work = []
+        for i in range(jobs):
+            shmnames = {name: block.name for name, block in blocks[i].items()}
+            work.append((filenames[i::jobs], mode, shape, dtype, kappa, maxval, stepmax, shmnames))
+        with Pool(jobs) as pool:
+            counts = pool.starmap(stack_worker, work)
+
+        stacker = Stacker(mode, shape, dtype, kappa=kappa, maxval=maxval, stepmax=stepmax)
+        for worker_blocks, count in zip(blocks, counts):
+            partial = Stacker(mode, shape, dtype, kappa=kappa, alloc=shm_alloc(worker_blocks),
+                              maxval=maxval, stepmax=stepmax)
+            partial.count = count
+            stacker.merge(partial)
+            del partial
+        return stacker
+    finally:
+        for worker_blocks in blocks:
+            for block in worker_blocks.values():
+                block.close()
+                block.unlink()
+
+def file_stat(filename):
+    st = os.stat(filename)
+    return [st.st_mtime, st.st_size]
+
+def save_checkpoint(filename, stacker, manifest):
+    # Write to a temporary name and rename so a crash never leaves a
+    # truncated checkpoint behind
+    arrays = {"buf_" + name: buf for name, buf in stacker.buffers.items()}
+    tmpname = filename + ".new"
+    with open(tmpname, "wb") as f:
+        np.savez(f, mode=stacker.mode, dtype=stacker.dtype.str, kappa=stacker.kappa, maxval=stacker.maxval,
+                 stepmax=stacker.stepmax, count=stacker.count, manifest=json.dumps(manifest, sort_keys=True), **arrays)
+    os.rename(tmpname, filename)
+
+def load_checkpoint(filename):
+    with np.load(filename) as ckpt:
+        arrays = {key[4:]: ckpt[key] for key in ckpt.files if key.startswith("buf_")}
+        mode = str(ckpt["mode"])
+        first = next(iter(arrays.values()))
+        # Checkpoints from before maxval was saved used the dtype's range,
+        # and ones from before stepmax could have saved a guessed maxval,
+        # which is only safe to size the median steps with
+        maxval = float(ckpt["maxval"]) if "maxval" in ckpt.files else None
+        stepmax = float(ckpt["stepmax"]) if "stepmax" in ckpt.files else None
+        if stepmax is None:
+            maxval, stepmax = None, maxval
+        stacker = Stacker(mode, first.shape, np.dtype(str(ckpt["dtype"])), kappa=float(ckpt["kappa"]),
+                          alloc=lambda name, shape, dtype: arrays[name].astype(dtype, copy=False),
+                          maxval=maxval, stepmax=stepmax)
+        stacker.count = int(ckpt["count"])
+        manifest = json.loads(str(ckpt["manifest"]))
+    return stacker, manifest
+
 def main():
     usage = "usage: %prog [options] arg ..."
     parser = OptionParser(usage)
     parser.set_defaults(output="stack.fit")
+    parser.set_defaults(mode=None)
+    parser.set_defaults(kappa=None)
+    parser.set_defaults(jobs=1)
+    parser.set_defaults(bitdepth=None)
+    parser.set_defaults(checkpoint=None)
+    parser.set_defaults(nocheckpoint=False)
+    parser.set_defaults(seed=[])
 #    parser.set_defaults(overwrite=False)
 
     parser.add_option("--output", dest="output",help="Mean filename")
+    parser.add_option("--mode", dest="mode", type="choice", choices=MODES,
+                      help="Stacking mode, one of %s [default: max, or the checkpoint's mode]" % ", ".join(MODES))
+    parser.add_option("--kappa", dest="kappa", type="float",
+                      help="Clipping threshold in standard deviations for sigma mode, must match the checkpoint's [default: 3, or the checkpoint's kappa]")
+    parser.add_option("--bitdepth", dest="bitdepth", type="int",
+                      help="Bits per sample of the frames, e.g. 12 for raw frames, the result is clipped to this range [default: a FITS frame's BITDEPTH, otherwise the dtype's range]")
+    parser.add_option("--jobs", dest="jobs", type="int",
+                      help="Number of decode/stack worker processes [default: %default]")
+    parser.add_option("--checkpoint", dest="checkpoint",
+                      help="Accumulator checkpoint to resume from and update [default: OUTPUT.ckpt.npz]")
+    parser.add_option("--no-checkpoint",
+                      action="store_true", dest="nocheckpoint", help="Do not read or write a checkpoint")
+    parser.add_option("--seed", dest="seed", action="append",
+                      help="Start from this checkpoint instead of the output's own, may be repeated to combine several (e.g. one per night)")
 #    parser.add_option("--overwrite",
 #                      action="store_true", dest="overwrite", help="Overwrite output files")
 
     (options, args) = parser.parse_args()
 
-    if len(args) < 1:
+    if len(args) < 1 and not options.seed:
         parser.error("incorrect number of arguments")
 
+    if options.checkpoint is None:
+        options.checkpoint=options.output+".ckpt.npz"
+
+    stacker=None
+    manifest={}
+
+    # Seeds replace the output's own checkpoint, otherwise frames already in
+    # the seeds would be counted twice when it is re-run
+    if options.seed:
+        for seed in options.seed:
+            s, m = load_checkpoint(seed)
+            if stacker is None:
+                stacker=s
+            else:
+                try:
+                    stacker.merge(s)
+                except ValueError as e:
+                    parser.error("%s: %s" % (seed, e))
+            manifest.update(m)
+    elif not options.nocheckpoint and os.path.exists(options.checkpoint):
+        stacker, manifest = load_checkpoint(options.checkpoint)
 
-    stack=None
+    if options.mode is None:
+        options.mode = "max" if stacker is None else stacker.mode
+    elif stacker is not None and stacker.mode != options.mode:
+        parser.error("checkpoint was stacked with mode %s, not %s" % (stacker.mode, options.mode))
 
+    # New frames, and the partial stacks of --jobs workers, are clipped with
+    # the same kappa as the checkpoint they are merged into
+    if options.kappa is None:
+        options.kappa = 3.0 if stacker is None else stacker.kappa
+    elif stacker is not None and stacker.mode == "sigma" and stacker.kappa != options.kappa:
+        parser.error("checkpoint was stacked with kappa %g, not %g" % (stacker.kappa, options.kappa))
+
+    pending=[]
+    stats={}
     for filename in args:
-        img = Image.open(filename)
-        d=np.asarray(img)
+        key=os.path.abspath(filename)
+        stats[key]=file_stat(filename)
+        if key in manifest:
+            if manifest[key] != stats[key]:
+                print("%s has changed since it was stacked, skipping" % filename)
+            continue
+        pending.append(filename)
+
+    jobs=max(1, min(options.jobs, len(pending)))
 
-        if stack is None:
-            stack=d
+    if jobs > 1:
+        s=parallel_stack(pending, jobs, options.mode, options.kappa, options.bitdepth)
+        if stacker is None:
+            stacker=s
         else:
-            stack=np.max([d,stack],axis=0)
+            stacker.merge(s)
+    else:
+        for filename in pending:
+            d=load(filename)
+
+            if stacker is None:
+                maxval, stepmax = data_maxval(filename, d, options.bitdepth)
+                stacker=Stacker(options.mode, d.shape, d.dtype, kappa=options.kappa,
+                                maxval=maxval, stepmax=stepmax)
+            stacker.add(d)
 
-    im = Image.fromarray(stack)
-    im.save(options.output)
+    for filename in pending:
+        key=os.path.abspath(filename)
+        manifest[key]=stats[key]
+
+    if stacker is None:
+        parser.error("nothing to stack")
+
+    print("Stacked %d new frames, %d total" % (len(pending), stacker.count))
+
+    if not options.nocheckpoint:
+        save_checkpoint(options.checkpoint, stacker, manifest)
+
+    result = stacker.result()
+    if rawframe.is_fits(options.output):
+        rawframe.write_fits(options.output, result, {"NCOMBINE": stacker.count, "STACKMOD": stacker.mode})
+    else:
+        im = Image.fromarray(result)
+        im.save(options.output)
 
 
 if __name__ == "__main__":
     main()
-
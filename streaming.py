@@ -0,0 +1,215 @@
+import socket
+import asyncio
+import logging
+import socketserver
+from http import server
+from urllib.parse import urlsplit, parse_qs
+
+from broadcast import Lagged, LATEST
+
+# HTTP side shared by the MJPEG streaming scripts, serves a page plus any
+# number of streams each fed by a FrameBroadcast (or chosen by a selector,
+# a callable taking the parsed query string and returning one), and
+# optionally endpoints, callables taking the parsed query string and
+# returning (content type, body). Endpoints may block for a moment, the
+# asyncio server runs them on a thread.
+
+def select_stream(output, query):
+    if callable(output):
+        return output(parse_qs(query))
+    return output
+
+class StreamingHandler(server.BaseHTTPRequestHandler):
+    page = ""
+    streams = {}
+    endpoints = {}
+    policy = LATEST
+    maxlag = 2
+    sndbuf = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        path = url.path
+        if path == '/':
+            self.send_response(301)
+            self.send_header('Location', '/index.html')
+            self.end_headers()
+        elif path == '/index.html':
+            content = self.page.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', len(content))
+            self.end_headers()
+            self.wfile.write(content)
+        elif path in self.streams:
+            try:
+                output = select_stream(self.streams[path], url.query)
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+            self.stream(output)
+        elif path in self.endpoints:
+            try:
+                content_type, content = self.endpoints[path](parse_qs(url.query))
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', len(content))
+            self.send_header('Cache-Control', 'no-cache, private')
+            self.end_headers()
+            self.wfile.write(content)
+        else:
+            self.send_error(404)
+            self.end_headers()
+
+    def stream(self, output):
+        self.send_response(200)
+        self.send_header('Age', 0)
+        self.send_header('Cache-Control', 'no-cache, private')
+        self.send_header('Pragma', 'no-cache')
+        self.send_header('Content-Type', output.content_type)
+        self.end_headers()
+        if self.sndbuf:
+            # A small kernel buffer makes a slow client block the write
+            # rather than queue seconds of frames, so its lag is visible
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        try:
+            with output.subscribe(self.policy, self.maxlag) as sub:
+                while True:
+                    seq, part, stamp = sub.get()
+                    self.wfile.write(part)
+                    output.record_send(stamp)
+        except Lagged as e:
+            logging.warning(
+                'Disconnected lagging client %s: %s',
+                self.client_address, str(e))
+        except Exception as e:
+            logging.warning(
+                'Removed streaming client %s: %s',
+                self.client_address, str(e))
+
+
+class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class AsyncStreamingServer:
+    # Single threaded alternative to StreamingServer, every viewer is a
+    # coroutine rather than an OS thread. Each prebuilt part is queued with
+    # one write and a viewer whose socket buffer passes highwater
+    # stops being sent frames until it drains, skipping to newer frames
+    # under its lag policy rather than queueing stale ones.
+    def __init__(self, address, page, streams, policy=LATEST, maxlag=2, highwater=256*1024, endpoints=None, sndbuf=None):
+        self.address = address
+        self.page = page.encode('utf-8')
+        self.streams = streams
+        self.endpoints = endpoints or {}
+        self.policy = policy
+        self.maxlag = maxlag
+        self.highwater = highwater
+        self.sndbuf = sndbuf
+        self.events = {}
+
+    def notify(self, output):
+        event = self.events[output]
+        self.events[output] = asyncio.Event()
+        event.set()
+
+    def watch(self, output):
+        # Event set (and replaced) after every frame written to output
+        if output not in self.events:
+            loop = asyncio.get_running_loop()
+            self.events[output] = asyncio.Event()
+            output.add_listener(lambda: loop.call_soon_threadsafe(self.notify, output))
+
+    async def send(self, writer, status, headers, body=b''):
+        lines = ['HTTP/1.0 %s' % status] + ['%s: %s' % h for h in headers]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+    async def bad_request(self, writer, e):
+        msg = str(e).encode('utf-8')
+        await self.send(writer, '400 Bad Request', [('Content-Type', 'text/plain'), ('Content-Length', len(msg))], msg)
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+            method, target = request.split(b'\r\n', 1)[0].decode('latin-1').split(' ')[:2]
+            url = urlsplit(target)
+            path = url.path
+            if method != 'GET':
+                await self.send(writer, '405 Method Not Allowed', [('Content-Length', 0)])
+            elif path == '/':
+                await self.send(writer, '301 Moved Permanently', [('Location', '/index.html'), ('Content-Length', 0)])
+            elif path == '/index.html':
+                await self.send(writer, '200 OK', [('Content-Type', 'text/html'), ('Content-Length', len(self.page))], self.page)
+            elif path in self.streams:
+                try:
+                    output = select_stream(self.streams[path], url.query)
+                except ValueError as e:
+                    await self.bad_request(writer, e)
+                else:
+                    await self.stream(writer, output)
+            elif path in self.endpoints:
+                try:
+                    content_type, content = await asyncio.get_running_loop().run_in_executor(
+                        None, self.endpoints[path], parse_qs(url.query))
+                except ValueError as e:
+                    await self.bad_request(writer, e)
+                else:
+                    await self.send(writer, '200 OK', [('Content-Type', content_type),
+                                                       ('Content-Length', len(content)),
+                                                       ('Cache-Control', 'no-cache, private')], content)
+            else:
+                await self.send(writer, '404 Not Found', [('Content-Length', 0)])
+        except Lagged as e:
+            logging.warning('Disconnected lagging client %s: %s', peer, str(e))
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError) as e:
+            logging.warning('Removed streaming client %s: %s', peer, str(e))
+        finally:
+            writer.close()
+
+    async def stream(self, writer, output):
+        self.watch(output)
+        writer.transport.set_write_buffer_limits(high=self.highwater)
+        if self.sndbuf:
+            writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        await self.send(writer, '200 OK', [('Age', 0),
+                                           ('Cache-Control', 'no-cache, private'),
+                                           ('Pragma', 'no-cache'),
+                                           ('Content-Type', output.content_type)])
+        with output.subscribe(self.policy, self.maxlag) as sub:
+            while True:
+                event = self.events[output]
+                item = sub.get(timeout=0)
+                if item is None:
+                    await event.wait()
+                    continue
+                seq, part, stamp = item
+                writer.write(part)
+                await writer.drain()
+                output.record_send(stamp)
+
+    async def serve_forever(self):
+        httpd = await asyncio.start_server(self.handle, self.address[0] or None, self.address[1], reuse_address=True)
+        async with httpd:
+            await httpd.serve_forever()
+
+
+SERVERS = ("threading", "asyncio")
+
+def make_handler(page, streams, policy=LATEST, maxlag=2, endpoints=None, sndbuf=None):
+    return type('StreamingHandler', (StreamingHandler,),
+                {'page': page, 'streams': streams, 'policy': policy, 'maxlag': maxlag,
+                 'endpoints': endpoints or {}, 'sndbuf': sndbuf})
+
+def serve(address, page, streams, policy=LATEST, maxlag=2, mode="threading", endpoints=None, sndbuf=None):
+    if mode == "asyncio":
+        asyncio.run(AsyncStreamingServer(address, page, streams, policy, maxlag, endpoints=endpoints, sndbuf=sndbuf).serve_forever())
+    else:
+        httpd = StreamingServer(address, make_handler(page, streams, policy, maxlag, endpoints, sndbuf))
+        httpd.serve_forever()
@@ -4,17 +4,19 @@ import datetime
 import sys
 import os
 import argparse
-import simplejpeg
-import piexif
-import piexif.helper
-import io
 import json
+import threading
+import collections
 
-import cv2
+import numpy as np
 
-from picamera2 import MappedArray, Picamera2
-from libcamera import controls, Transform
-from picamera2.encoders import H264Encoder
+from metadata_log import MetadataLog
+from exif_writer import exif_template, write_jpeg
+from overlay import Overlay, DEFAULT_TEMPLATE, POSITIONS
+import framesource
+import metrics
+import rawframe
+import faststart
 
 parser = argparse.ArgumentParser(description='Pi Timelapse', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument('--interval', type=int, default=15, help='Timelapse interval (s)')
@@ -22,11 +24,21 @@ parser.add_argument('--binning', type=int, default=2, help='Downscale sensor res
 parser.add_argument('--maxgain', type=float, default=12.0, help='Maximum gain')
 parser.add_argument('--dirname', type=str, default="imgs/", help='Directory to save images')
 parser.add_argument('--filename', type=str, default="%Y/%m/%d/%Y%m%dT%H%M%S.jpg", help='Filename template (parsed with strftime, directories automatically created)')
+parser.add_argument('--format', type=str, default="jpeg", choices=("jpeg",)+tuple(rawframe.EXTENSIONS), help='Save processed JPEGs, or raw Bayer frames as 16 bit .npy or FITS for stack.py (no overlay, filename extensions are replaced)')
+parser.add_argument('--rawformat', type=str, default="SRGGB12", help='Unpacked raw format for --format npy/fits, e.g. SRGGB16 on a Pi 5')
 parser.add_argument('--latest', type=str, default="latest.jpg", help='Name of file to symlink latest image to')
-parser.add_argument('--metadata', type=str, default="%Y/%m/%d/metadata.json", help='Separate dump of image metadata')
+parser.add_argument('--metadata', type=str, default="%Y/%m/%d/metadata.jsonl", help='Separate append-only JSON Lines log of image metadata, a .json name is changed to .jsonl (export the old metadata.json with metadata_log.py export)')
+parser.add_argument('--metadatasync', type=int, default=10, help='Frames between fsyncs of the metadata log')
+parser.add_argument('--workers', type=int, default=0, help='Encode/write worker threads shared by all cameras, 0 encodes and writes on the capture thread (one per camera with several)')
+parser.add_argument('--queuedepth', type=int, default=2, help='Frames waiting for a worker before the oldest is dropped')
+parser.add_argument('--queuewait', type=float, default=0.5, help='Time (s) capture waits for a free frame buffer before dropping the oldest queued frame, or this one if none is queued')
 parser.add_argument('--tuningfile', type=str, default=None, help='Base tuning file for camera, AGC parameters will be overridden')
-parser.add_argument('--camera', type=int, default=0, help='Camera Number')
+parser.add_argument('--camera', type=int, nargs='+', default=[0], help='Camera Number, several are captured from one process with _camN added to their filenames')
+parser.add_argument('--probecache', type=str, default="~/.cache/timelapse-probe.json", help='Cache of each camera\'s model and patched tuning so restarts skip the camera probe, empty to always probe (not used with --tuningfile)')
+parser.add_argument('--reprobe', default=False, help='Probe the cameras and refresh the cache', action='store_true')
 parser.add_argument('--rotate', default=False, help='Rotate image 180', action='store_true')
+framesource.add_source_arguments(parser)
+metrics.add_metrics_arguments(parser,port=True)
 
 syncgroup = parser.add_mutually_exclusive_group()
 syncgroup.add_argument('--syncserver', default=False, help='Camera Sync, server mode', action='store_true')
@@ -34,7 +46,13 @@ syncgroup.add_argument('--syncclient', default=False, help='Camera Sync, client
 
 parser.add_argument('--syncreadyframe', type=int, default=None, help='How many frames for sync server to wait before declaring itself ready')
 parser.add_argument('--syncperiod', type=int, default=None, help='How often the sync server should advertise timing')
+parser.add_argument('--pair', default=False, help='Save frames from several cameras as groups matched by sensor timestamp (always on with sync)', action='store_true')
+parser.add_argument('--pairtolerance', type=float, default=0.01, help='Most difference (s) in sensor timestamps within a group')
 
+parser.add_argument('--overlay', type=str, default=DEFAULT_TEMPLATE.replace("\n","\\n"), help='Overlay text template, str.format fields from the frame metadata plus timestamp and exposure (s), lines separated by \\n, empty for no overlay')
+parser.add_argument('--overlayposition', type=str, default="topleft", choices=POSITIONS, help='Overlay corner')
+parser.add_argument('--overlayscale', type=float, default=0.7, help='Overlay font scale')
+parser.add_argument('--overlayopacity', type=float, default=1.0, help='Opacity of the box behind the overlay text')
 #parser.add_argument('--font', type=str, default='/usr/share/fonts/truetype/ttf-bitstream-vera/VeraBd.ttf', help='TTF font file for overlay text')
 #parser.add_argument('--fontsize', type=int, default=12, help='Font size for overlay text')
 
@@ -42,9 +60,59 @@ parser.add_argument('--debug', default=False, help='Debug mode', action='store_t
 
 args = parser.parse_args()
 
-
-
-if args.tuningfile is None:
+# The log is JSON Lines, appending it to an old style metadata.json (the old
+# default, which service files may still pass) would leave neither readable
+if args.metadata is not None and args.metadata.endswith(".json"):
+    args.metadata+="l"
+    print("Writing the metadata log to %s, metadata.json can be exported from it with metadata_log.py export"%args.metadata)
+
+if args.format!="jpeg":
+    ext=rawframe.EXTENSIONS[args.format]
+    args.filename=os.path.splitext(args.filename)[0]+ext
+    if args.latest:
+        args.latest=os.path.splitext(args.latest)[0]+ext
+
+cam=framesource.camera_module(args.source,args.sourcefps)
+Picamera2, MappedArray = cam.Picamera2, cam.MappedArray
+controls, Transform = cam.controls, cam.Transform
+
+# Several cameras are driven from one process, each with its own tuning,
+# configuration and overlay, captured on its own thread. Saving is shared:
+# one metadata log and one pool of encode/write workers for every camera.
+multi=len(args.camera)>1
+pairing=multi and (args.syncserver or args.syncclient or args.pair)
+if multi and args.workers==0:
+    args.workers=len(args.camera)
+
+def probe_key(num):
+    return [num,args.tuningfile,args.interval,args.maxgain,args.syncreadyframe,args.syncperiod]
+
+def tuning_stamp(tuningfile):
+    # Where libcamera finds a tuning file and its mtime and size, so an edit
+    # or a new one from an update isn't hidden by the cache
+    try:
+        path=Picamera2.find_tuning_file(tuningfile)
+        st=os.stat(path)
+    except (OSError,RuntimeError):
+        return None
+    return [path,st.st_mtime,st.st_size]
+
+# The patched tuning for each camera is cached along with the model it was
+# for, keyed by everything that went into it. When every camera is in the
+# cache the probe and CameraManager reset below are skipped. There is no
+# probe with --tuningfile, so nothing to cache.
+probecache=None
+cached={}
+if cam.real and args.probecache and args.tuningfile is None:
+    probecache=faststart.ProbeCache(args.probecache)
+    if not args.reprobe:
+        for num in args.camera:
+            entry=probecache.get(probe_key(num))
+            if entry is not None and entry.get("tuningstamp")==tuning_stamp(entry["model"]+".json"):
+                cached[num]=entry
+
+tuningfiles={num:args.tuningfile for num in args.camera}
+if cam.real and args.tuningfile is None and len(cached)<len(args.camera):
     allcams=Picamera2.global_camera_info()
 
     # Seems global_camera_info initialises the libcamera object so 
@@ -58,126 +126,391 @@ if args.tuningfile is None:
     Picamera2._cm = CameraManager()
 
     for c in allcams:
-        if c['Num']==args.camera:
-            args.tuningfile=c['Model']+'.json'
-
-tuning = Picamera2.load_tuning_file(args.tuningfile)
-agc = Picamera2.find_tuning_algo(tuning, "rpi.agc")
-if "channels" in agc:
-    agc["channels"][0]["exposure_modes"]["normal"] = {"shutter": [100,int(args.interval*1000000)], "gain": [1.0,args.maxgain]}
-else:
-    agc["exposure_modes"]["normal"] = {"shutter": [100,int(args.interval*1000000)], "gain": [1.0,args.maxgain]}
-
-sync=Picamera2.find_tuning_algo(tuning, "rpi.sync")
-if args.syncreadyframe:
-    sync["ready_frame"]=args.syncreadyframe
-if args.syncperiod:
-    sync["sync_period"]=5
-
-picam2 = Picamera2(tuning=tuning,camera_num=args.camera)
-
-ctrls={}
-ctrls["FrameDurationLimits"]= (int(args.interval*1000000), int(args.interval*1000000))
-# Off Fast HighQuality
-ctrls["NoiseReductionMode"]=controls.draft.NoiseReductionModeEnum.Off
-
-if args.syncserver:
-    ctrls['SyncMode']=controls.rpi.SyncModeEnum.Server
-elif args.syncclient:
-    ctrls['SyncMode']=controls.rpi.SyncModeEnum.Client
+        if c['Num'] in tuningfiles:
+            tuningfiles[c['Num']]=c['Model']+'.json'
+
+def load_tuning(tuningfile):
+    tuning = Picamera2.load_tuning_file(tuningfile)
+    agc = Picamera2.find_tuning_algo(tuning, "rpi.agc")
+    if "channels" in agc:
+        agc["channels"][0]["exposure_modes"]["normal"] = {"shutter": [100,int(args.interval*1000000)], "gain": [1.0,args.maxgain]}
+    else:
+        agc["exposure_modes"]["normal"] = {"shutter": [100,int(args.interval*1000000)], "gain": [1.0,args.maxgain]}
+
+    sync=Picamera2.find_tuning_algo(tuning, "rpi.sync")
+    if args.syncreadyframe:
+        sync["ready_frame"]=args.syncreadyframe
+    if args.syncperiod:
+        sync["sync_period"]=args.syncperiod
+    return tuning
 
 if args.rotate:
     transform=Transform(hflip=True, vflip=True)
 else:
     transform=Transform()
 
-size=tuple(int(x/args.binning) for x in picam2.sensor_resolution)
-
-sc=picam2.create_still_configuration({'size':size,'format':'XBGR8888'},controls=ctrls,buffer_count=2,transform=transform)
-
-picam2.configure(sc)
-
-foreground = (255, 255, 255)
-background = (0,0,0)
-
-origin = (0, 30)
-font = cv2.FONT_HERSHEY_SIMPLEX
-scale = 0.7
-thickness = 2
-
-def apply_timestamp(request,dt):
+# Raw frames come from the raw stream at the binned size, the camera picks
+# the sensor mode that matches it
+stream="main"
+if args.format!="jpeg":
+    stream="raw"
+
+def suffixed(name,num):
+    # With several cameras each one's files and latest link get _camN
+    if not multi:
+        return name
+    base,ext=os.path.splitext(name)
+    return "%s_cam%d%s"%(base,num,ext)
+
+class Camera:
+    def __init__(self,num,syncmode=None):
+        self.num=num
+        tuning=None
+        if num in cached:
+            tuning=cached[num]["tuning"]
+        elif cam.real:
+            tuning=load_tuning(tuningfiles[num])
+        self.picam2=Picamera2(tuning=tuning,camera_num=num)
+        if probecache is not None:
+            model=self.picam2.camera_properties.get("Model")
+            if num not in cached:
+                probecache.put(probe_key(num),{"model":model,"tuning":tuning,"tuningstamp":tuning_stamp(tuningfiles[num])})
+            elif cached[num]["model"]!=model:
+                # A different sensor on this port, its tuning is already loaded
+                probecache.remove(probe_key(num))
+                probecache.save()
+                sys.exit("Camera %d is now a %s, not the cached %s, restart to probe it"%(num,model,cached[num]["model"]))
+
+        ctrls={}
+        ctrls["FrameDurationLimits"]= (int(args.interval*1000000), int(args.interval*1000000))
+        # Off Fast HighQuality
+        ctrls["NoiseReductionMode"]=controls.draft.NoiseReductionModeEnum.Off
+        if syncmode is not None:
+            ctrls['SyncMode']=syncmode
+
+        size=tuple(int(x/args.binning) for x in self.picam2.sensor_resolution)
+        rawconfig={}
+        if stream=="raw":
+            rawconfig['raw']={'size':size,'format':args.rawformat}
+        sc=self.picam2.create_still_configuration({'size':size,'format':'XBGR8888'},controls=ctrls,buffer_count=2,transform=transform,**rawconfig)
+        self.picam2.configure(sc)
+
+        self.overlay=Overlay(template=args.overlay.replace("\\n","\n"),position=args.overlayposition,scale=args.overlayscale,opacity=args.overlayopacity)
+        self.linkname=suffixed(args.latest,num) if args.latest else None
+
+    def filename(self,dt):
+        return suffixed(dt.strftime(args.filename),self.num)
+
+# --syncserver makes the first camera the server and any others its
+# clients, --syncclient makes them all clients of a server elsewhere
+cameras=[]
+for i,num in enumerate(args.camera):
+    syncmode=None
+    if args.syncserver:
+        syncmode=controls.rpi.SyncModeEnum.Server if i==0 else controls.rpi.SyncModeEnum.Client
+    elif args.syncclient:
+        syncmode=controls.rpi.SyncModeEnum.Client
+    cameras.append(Camera(num,syncmode))
+
+registry=metrics.REGISTRY
+capture_time=registry.histogram("timelapse_capture_wait_seconds","Time waiting for the camera to return a frame")
+overlay_time=registry.histogram("timelapse_overlay_seconds","Time drawing the overlay")
+encode_time=registry.histogram("timelapse_encode_seconds","Time JPEG encoding")
+exif_time=registry.histogram("timelapse_exif_seconds","Time building the EXIF segment")
+write_time=registry.histogram("timelapse_write_seconds","Time writing the frames of a job and the metadata log")
+saved_frames=registry.counter("timelapse_frames_saved_total","Frames written to disk")
+
+def apply_timestamp(camera,request,dt):
     md=request.get_metadata()
     if args.debug:
-        print("Cam %d exp %f ag %f dg %f"%(args.camera,md['ExposureTime']/1000000,md['AnalogueGain'],md['DigitalGain']))
-    text=[]
-    text.append(dt.isoformat())
-    text.append("EXP: %f AG: %f DG: %f"%(md['ExposureTime']/1000000,md['AnalogueGain'],md['DigitalGain']))
-    text.append("TEMP: %f LUX: %f CT: %d Focus: %d"%(md['SensorTemperature'],md['Lux'],md['ColourTemperature'],md['FocusFoM']))
-
-    with MappedArray(request, "main") as m:
-        y=-2
-        for a in text:
-            (w, h), baseline=cv2.getTextSize(a,font, scale, thickness)
-            y+=h+6
-            cv2.rectangle(m.array,(0,y+1+baseline),(w+2,y-h-2),background,-1)
-            cv2.putText(m.array, a, (1,y), font, scale, foreground, thickness)
+        print("Cam %d exp %f ag %f dg %f"%(camera.num,md['ExposureTime']/1000000,md['AnalogueGain'],md['DigitalGain']))
+
+    # Never drawn into raw frames, which are data for stacking
+    if stream=="main":
+        t0=time.perf_counter()
+        with MappedArray(request, "main") as m:
+            camera.overlay.apply(m.array,dt,md)
+        overlay_time.observe(time.perf_counter()-t0)
 
 JPEG_FORMAT_TABLE = {"XBGR8888": "RGBX",
                 "XRGB8888": "BGRX",
                 "BGR888": "RGB",
                 "RGB888": "BGR"}
 
-def savejpeg(request,name,dt,dirname,filename,linkname=None,mdfilename=None):
-    if '/' in filename:
-        os.makedirs(os.path.dirname(os.path.join(dirname,filename)),exist_ok=True)
-    #request.save(name,os.path.join(dirname,filename))
-
-    jpeg_bytes=simplejpeg.encode_jpeg(request.make_array(name), quality=90, colorspace=JPEG_FORMAT_TABLE[request.config[name]["format"]], colorsubsampling="420")
-
-    metadata=request.get_metadata()
+def stream_array(array,config):
+    # Unpacked raw buffers are bytes with padded rows
+    if stream=="raw":
+        return rawframe.bayer_view(array,config["size"][0])
+    return array
+
+def stream_colorspace(config):
+    # The raw format (e.g. SRGGB12) stands in for the colour space of raw frames
+    if stream=="raw":
+        return config["format"]
+    return JPEG_FORMAT_TABLE[config["format"]]
+
+latest_lock=threading.Lock()
+latest_dts={}
+
+def link_latest(dt,dirname,filename,linkname):
+    # Workers can finish out of order, never point latest at an older frame
+    with latest_lock:
+        if linkname not in latest_dts or dt > latest_dts[linkname]:
+            latest_dts[linkname]=dt
+            os.symlink(filename,os.path.join(dirname,linkname+".new"))
+            os.rename(os.path.join(dirname,linkname+".new"),os.path.join(dirname,linkname))
+
+def encodejpeg(array,colorspace,metadata,dt,cameraid):
+    import simplejpeg
+    t0=time.perf_counter()
+    jpeg_bytes=simplejpeg.encode_jpeg(array, quality=90, colorspace=colorspace, colorsubsampling="420")
+    t1=time.perf_counter()
+    encode_time.observe(t1-t0)
+
+    app1=None
     if "AnalogueGain" in metadata and "DigitalGain" in metadata:
-        zero_ifd = {piexif.ImageIFD.Make: "Raspberry Pi",
-                    piexif.ImageIFD.Model: picam2.camera.id,
-                    piexif.ImageIFD.Software: "Picamera2",
-                    piexif.ImageIFD.DateTime: dt.strftime("%Y:%m:%d %H:%M:%S")}
         total_gain = metadata["AnalogueGain"] * metadata["DigitalGain"]
-        exif_ifd = {piexif.ExifIFD.DateTimeOriginal: dt.strftime("%Y:%m:%d %H:%M:%S"),
-                    piexif.ExifIFD.ExposureTime: (metadata["ExposureTime"], 1000000),
-                    piexif.ExifIFD.ISOSpeedRatings: int(total_gain * 100),
-                    piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(json.dumps(metadata,sort_keys=True))}
-        exif_bytes = piexif.dump({"0th": zero_ifd, "Exif": exif_ifd})
-        new_bytes=io.BytesIO()
-        piexif.insert(exif_bytes,jpeg_bytes,new_bytes)
-
-    with open(os.path.join(dirname,filename),"wb") as file:
-        file.write(new_bytes.getbuffer())
-
-    if mdfilename is not None:
-        with open(os.path.join(dirname,mdfilename),"a+") as mdfile:
-            mdfile.seek(0)
-            mdstr=mdfile.read()
+        template = exif_template("Raspberry Pi", cameraid, "Picamera2")
+        app1 = template.app1(dt, metadata["ExposureTime"], total_gain * 100, json.dumps(metadata,sort_keys=True))
+    exif_time.observe(time.perf_counter()-t1)
+    return jpeg_bytes,app1
+
+def writejpeg(path,encoded):
+    write_jpeg(path,*encoded)
+
+def encoderaw(array,format,metadata,dt,cameraid):
+    if args.format!="fits":
+        return array,None
+    pattern,bits=rawframe.raw_format_info(format)
+    header={"DATE-OBS":dt.strftime("%Y-%m-%dT%H:%M:%S.%f"),"INSTRUME":cameraid,"BAYERPAT":pattern,"BITDEPTH":bits}
+    if "ExposureTime" in metadata:
+        header["EXPTIME"]=metadata["ExposureTime"]/1000000
+    if "AnalogueGain" in metadata and "DigitalGain" in metadata:
+        header["GAIN"]=metadata["AnalogueGain"]*metadata["DigitalGain"]
+    return array,header
+
+def writeraw(path,encoded):
+    array,header=encoded
+    if args.format=="fits":
+        rawframe.write_fits(path,array,header)
+    else:
+        # A file object so np.save doesn't add .npy to a temporary name
+        with open(path,"wb") as f:
+            np.save(f,array)
+
+encode,write=(encodejpeg,writejpeg) if stream=="main" else (encoderaw,writeraw)
+
+def saveframes(frames,dt,mdfilename):
+    # frames is [(array, colorspace, metadata, camera, filename)]. Several
+    # frames (a synchronised group) are written under temporary names and
+    # only renamed into place, logged and linked once all of them are on
+    # disk, so the log and the directory never show part of a group.
+    encoded=[encode(array,colorspace,metadata,dt,camera.picam2.camera.id) for array,colorspace,metadata,camera,filename in frames]
+    t0=time.perf_counter()
+    temp=".new" if len(frames)>1 else ""
+    for (array,colorspace,metadata,camera,filename),e in zip(frames,encoded):
+        if '/' in filename:
+            os.makedirs(os.path.dirname(os.path.join(args.dirname,filename)),exist_ok=True)
+        write(os.path.join(args.dirname,filename)+temp,e)
+    for array,colorspace,metadata,camera,filename in frames:
+        if temp:
+            os.rename(os.path.join(args.dirname,filename)+temp,os.path.join(args.dirname,filename))
+        if mdfilename is not None:
+            mdlog.append(os.path.join(args.dirname,mdfilename),os.path.basename(filename),metadata)
+    write_time.observe(time.perf_counter()-t0)
+    saved_frames.inc(len(frames))
+
+    for array,colorspace,metadata,camera,filename in frames:
+        if camera.linkname is not None:
+            link_latest(dt,args.dirname,filename,camera.linkname)
+
+def make_job(frames,dt):
+    # Names every frame of a group after the same time
+    mdfilename=dt.strftime(args.metadata) if args.metadata is not None else None
+    return [frame+(frame[3].filename(dt),) for frame in frames],dt,mdfilename
+
+class SavePipeline:
+    # Copies each frame into one of a fixed set of buffers so the request can
+    # be released straight away, then encodes and writes on worker threads
+    # (simplejpeg and file I/O release the GIL) shared by every camera.
+    # Buffers are kept per frame shape as cameras may differ. When every
+    # buffer is busy capture waits up to queuewait for one, then drops the
+    # oldest queued job holding a buffer it can use, or if none is queued
+    # (they are all being written) the frame it is capturing.
+    def __init__(self,workers,queuedepth,queuewait,cameras=1,pairing=False):
+        self.condition=threading.Condition()
+        # When pairing, one more per camera for a frame waiting for its sync
+        # partner
+        self.nbuffers=(workers+max(queuedepth,1)+(1 if pairing else 0))*cameras
+        self.allocated=collections.Counter()
+        self.free=collections.defaultdict(collections.deque)
+        self.queue=collections.deque()
+        self.queuewait=queuewait
+        self.written=0
+        self.dropped=0
+        self.threads=[threading.Thread(target=self.worker,daemon=True) for i in range(workers)]
+        for t in self.threads:
+            t.start()
+
+    def getbuffer(self,frame):
+        key=(frame.shape,frame.dtype.str)
+        with self.condition:
+            free=self.free[key]
+            if not free and self.allocated[key]<self.nbuffers:
+                self.allocated[key]+=1
+                return np.empty_like(frame)
+            if not free:
+                self.condition.wait_for(lambda: free,timeout=self.queuewait)
+            if not free:
+                # Jobs from another camera hold buffers of another shape,
+                # dropping them wouldn't free one
+                for i,job in enumerate(self.queue):
+                    if any((f[0].shape,f[0].dtype.str)==key for f in job[0]):
+                        del self.queue[i]
+                        self.dropped+=len(job[0])
+                        print("Dropped frame %s, %d dropped %d written"%(", ".join(f[4] for f in job[0]),self.dropped,self.written))
+                        self.release(job[0])
+                        break
+            if not free:
+                return None
+            return free.popleft()
+
+    def release(self,frames):
+        for frame in frames:
+            self.free[(frame[0].shape,frame[0].dtype.str)].append(frame[0])
+        self.condition.notify_all()
+
+    def copy(self,request,name,camera):
+        metadata=request.get_metadata()
+        colorspace=stream_colorspace(request.config[name])
+        with MappedArray(request,name) as m:
+            array=stream_array(m.array,request.config[name])
+            buf=self.getbuffer(array)
+            if buf is not None:
+                np.copyto(buf,array)
+        request.release()
+        if buf is None:
+            with self.condition:
+                self.dropped+=1
+                print("Dropped frame from cam %d, %d dropped %d written"%(camera.num,self.dropped,self.written))
+            return None
+        return buf,colorspace,metadata,camera
+
+    def put(self,frames,dt):
+        job=make_job(frames,dt)
+        with self.condition:
+            self.queue.append(job)
+            self.condition.notify_all()
+
+    def worker(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queue)
+                frames,dt,mdfilename=self.queue.popleft()
+            saved=False
             try:
-                mdjson=json.loads(mdstr)
-            except json.decoder.JSONDecodeError:
-                print("Invalid or empty metadata json file, resetting")
-                mdjson={}
-            mdjson[os.path.basename(filename)]=metadata
-            mdfile.seek(0)
-            mdfile.truncate()
-            mdfile.write(json.dumps(mdjson,sort_keys=True))
-
-    if linkname is not None:
-        os.symlink(filename,os.path.join(dirname,linkname+".new"))
-        os.rename(os.path.join(dirname,linkname+".new"),os.path.join(dirname,linkname))
-
-picam2.start()
-mdfilename=None
-while True:
-    request=picam2.capture_request()
-    dt=datetime.datetime.utcnow()
-    apply_timestamp(request,dt)
-    filename=dt.strftime(args.filename)
-    if args.metadata is not None:
-        mdfilename=dt.strftime(args.metadata)
-    savejpeg(request,"main",dt,args.dirname,filename,args.latest,mdfilename)
-    request.release()
+                saveframes(frames,dt,mdfilename)
+                saved=True
+            except Exception as e:
+                print("Failed to save %s: %s"%(", ".join(f[4] for f in frames),e))
+            with self.condition:
+                self.release(frames)
+                if saved:
+                    self.written+=len(frames)
+            if args.debug:
+                print("Saved %s, %d dropped %d written"%(", ".join(f[4] for f in frames),self.dropped,self.written))
+
+class SyncPairer:
+    # Groups one frame from every camera whose sensor timestamps are within
+    # tolerance seconds of each other into one job. A frame that can no
+    # longer be matched, because another camera has moved past it or sent a
+    # newer frame of its own, is saved alone.
+    def __init__(self,nums,tolerance,put):
+        self.nums=nums
+        self.tolerance=int(tolerance*1000000000)
+        self.put=put
+        self.pending={}
+        self.lock=threading.Lock()
+        self.groups=0
+        self.unpaired=0
+
+    def add(self,num,frame,dt):
+        timestamp=frame[2].get("SensorTimestamp",0)
+        with self.lock:
+            if num in self.pending:
+                self.flush(num)
+            self.pending[num]=(timestamp,dt,frame)
+            newest=max(p[0] for p in self.pending.values())
+            for n in list(self.pending):
+                if self.pending[n][0]<newest-self.tolerance:
+                    self.flush(n)
+            if len(self.pending)==len(self.nums):
+                group=[self.pending[n] for n in self.nums]
+                self.pending={}
+                self.groups+=1
+                self.put([p[2] for p in group],min(p[1] for p in group))
+
+    def flush(self,num):
+        timestamp,dt,frame=self.pending.pop(num)
+        self.unpaired+=1
+        self.put([frame],dt)
+
+mdlog=MetadataLog(syncevery=args.metadatasync)
+
+pipeline=None
+if args.workers>0:
+    pipeline=SavePipeline(args.workers,args.queuedepth,args.queuewait,len(cameras),pairing)
+    registry.counter("timelapse_frames_dropped_total","Frames dropped with every save buffer busy",fn=lambda: pipeline.dropped)
+    registry.gauge("timelapse_queue_depth","Jobs waiting for a worker",fn=lambda: len(pipeline.queue))
+
+pairer=None
+if pairing:
+    pairer=SyncPairer([c.num for c in cameras],args.pairtolerance,pipeline.put)
+    registry.counter("timelapse_sync_groups_total","Groups of frames matched by sensor timestamp",fn=lambda: pairer.groups)
+    registry.counter("timelapse_sync_unpaired_total","Frames saved without a match from every camera",fn=lambda: pairer.unpaired)
+
+if args.metricsport is not None:
+    from streaming import serve
+    threading.Thread(target=serve,args=(('',args.metricsport),"",{}),kwargs={'endpoints':{'/metrics':registry.endpoint}},daemon=True).start()
+if args.metricslog:
+    registry.start_logging(args.metricslog)
+
+def capture(camera):
+    first=True
+    while True:
+        t0=time.perf_counter()
+        request=camera.picam2.capture_request()
+        capture_time.observe(time.perf_counter()-t0)
+        if first:
+            print("Cam %d first frame %.2fs after start"%(camera.num,faststart.since_start()))
+            first=False
+        dt=datetime.datetime.utcnow()
+        apply_timestamp(camera,request,dt)
+        if pipeline is None:
+            array=stream_array(request.make_array(stream),request.config[stream])
+            metadata=request.get_metadata()
+            colorspace=stream_colorspace(request.config[stream])
+            request.release()
+            saveframes(*make_job([(array,colorspace,metadata,camera)],dt))
+        else:
+            frame=pipeline.copy(request,stream,camera)
+            if frame is None:
+                continue
+            if pairer is not None:
+                pairer.add(camera.num,frame,dt)
+            else:
+                pipeline.put([frame],dt)
+
+for camera in cameras:
+    camera.picam2.start()
+if probecache is not None:
+    probecache.save()
+# The encoder and overlay are imported while the first exposure runs
+if stream=="main":
+    faststart.warm(["simplejpeg"]+(["cv2"] if args.overlay else []))
+startup=faststart.since_start()
+registry.gauge("timelapse_startup_seconds","Time from process start until the cameras were started",fn=lambda: startup)
+print("Started %d camera(s) in %.2fs%s"%(len(cameras),startup," with cached tuning" if cached else ""))
+for camera in cameras[1:]:
+    threading.Thread(target=capture,args=(camera,),daemon=True).start()
+capture(cameras[0])
@@ -1,15 +1,17 @@
 import time
 import datetime
-import io
-import logging
-import socketserver
+import argparse
 import threading
-from http import server
-from threading import Condition
 
-from picamera2 import Picamera2
-from picamera2.encoders import H264Encoder, MJPEGEncoder
-from picamera2.outputs import FileOutput,SplittableOutput
+import framesource
+import metrics
+import adaptive
+import simulcast
+import preevent
+import motion
+import frametap
+from broadcast import FrameBroadcast, POLICIES
+from streaming import serve, SERVERS
 
 # Get Picamera2 to encode an H264 stream, and encode another MJPEG one "manually".
 
@@ -25,65 +27,34 @@ PAGE = """\
 </html>
 """
 
-class StreamingOutput(io.BufferedIOBase):
-    def __init__(self):
-        self.frame = None
-        self.condition = Condition()
-
-    def write(self, buf):
-        with self.condition:
-            self.frame = buf
-            self.condition.notify_all()
-
-class StreamingHandler(server.BaseHTTPRequestHandler):
-    def do_GET(self):
-        if self.path == '/':
-            self.send_response(301)
-            self.send_header('Location', '/index.html')
-            self.end_headers()
-        elif self.path == '/index.html':
-            content = PAGE.encode('utf-8')
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/html')
-            self.send_header('Content-Length', len(content))
-            self.end_headers()
-            self.wfile.write(content)
-        elif self.path == '/stream.mjpg':
-            self.send_response(200)
-            self.send_header('Age', 0)
-            self.send_header('Cache-Control', 'no-cache, private')
-            self.send_header('Pragma', 'no-cache')
-            self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
-            self.end_headers()
-            try:
-                while True:
-                    with output.condition:
-                        output.condition.wait()
-                        frame = output.frame
-                    self.wfile.write(b'--FRAME\r\n')
-                    self.send_header('Content-Type', 'image/jpeg')
-                    self.send_header('Content-Length', len(frame))
-                    self.end_headers()
-                    self.wfile.write(frame)
-                    self.wfile.write(b'\r\n')
-            except Exception as e:
-                logging.warning(
-                    'Removed streaming client %s: %s',
-                    self.client_address, str(e))
-        else:
-            self.send_error(404)
-            self.end_headers()
-
-
-class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
-    allow_reuse_address = True
-    daemon_threads = True
+parser = argparse.ArgumentParser(description='H264 recorder with MJPEG preview server', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--port', type=int, default=8000, help='HTTP port')
+parser.add_argument('--lagpolicy', type=str, default="latest", choices=POLICIES, help='What to do with a client more than --maxlag frames behind')
+parser.add_argument('--maxlag', type=int, default=2, help='Frames a client may fall behind')
+parser.add_argument('--server', type=str, default="threading", choices=SERVERS, help='HTTP server, a thread per client or a single asyncio loop')
+framesource.add_source_arguments(parser)
+metrics.add_metrics_arguments(parser)
+adaptive.add_adaptive_arguments(parser)
+simulcast.add_simulcast_arguments(parser)
+parser.add_argument('--previewfps', type=float, default=15.0, help='Most frames a second encoded for the MJPEG preview, only while it has viewers')
+parser.add_argument('--previewquality', type=int, default=80, help='JPEG quality of the MJPEG preview')
+parser.add_argument('--record', type=str, default="continuous", choices=("continuous", "motion"), help='Record H.264 continuously in 60s files, or only clips around motion')
+parser.add_argument('--preroll', type=float, default=5.0, help='Seconds of video before a motion trigger to keep')
+parser.add_argument('--postroll', type=float, default=10.0, help='Seconds to keep recording after the last motion trigger')
+parser.add_argument('--bufferbytes', type=int, default=32*1024*1024, help='Memory for pre-event video, bounds --preroll at high bitrates')
+parser.add_argument('--motionfps', type=float, default=5.0, help='Rate the lores frame is checked for motion')
+parser.add_argument('--motionthreshold', type=int, default=20, help='Luma change counted as motion')
+parser.add_argument('--motionfraction', type=float, default=0.005, help='Fraction of pixels that must change to trigger')
+args = parser.parse_args()
+if args.adaptive and args.simulcast:
+    parser.error("--adaptive and --simulcast can't be combined")
+
+cam = framesource.camera_module(args.source, args.sourcefps)
+Picamera2, MappedArray, H264Encoder = cam.Picamera2, cam.MappedArray, cam.H264Encoder
+FileOutput, SplittableOutput = cam.FileOutput, cam.SplittableOutput
 
 def start_server():
-    address = ('', 8000)
-    server = StreamingServer(address, StreamingHandler)
-    print(server.__dict__.keys())
-    server.serve_forever()
+    serve(('', args.port), PAGE, streams, args.lagpolicy, args.maxlag, args.server, endpoints={'/metrics': registry.endpoint}, sndbuf=adaptive.sndbuf_from_args(args))
 
 def genfilename():
     dt=datetime.datetime.utcnow()
@@ -98,41 +69,72 @@ picam2 = Picamera2()
 config = picam2.create_video_configuration({"size": (1920, 1080)}, lores={"size": (int(1920/4), int(1080/4))})
 picam2.configure(config)
 
-h264_encoder = H264Encoder()
-h264_output = SplittableOutput(output=FileOutput(genfilename()))
-
-mjpeg_encoder = MJPEGEncoder()
-mjpeg_encoder.framerate = 30
-mjpeg_encoder.size = config["lores"]["size"]
-mjpeg_encoder.format = config["lores"]["format"]
-mjpeg_encoder.bitrate = 5000000
-output=StreamingOutput()
-mjpeg_encoder.output = FileOutput(output)
-mjpeg_encoder.start()
+# Headers repeated on every keyframe so pre-event clips can start at any of them
+h264_encoder = H264Encoder(repeat=True)
+if args.record == "motion":
+    h264_output = preevent.PreEventOutput(args.bufferbytes, args.preroll, args.postroll, "imgs/%Y%m%dT%H%M%S.h264")
+    detector = motion.MotionDetector(args.motionthreshold, args.motionfraction)
+else:
+    h264_output = SplittableOutput(output=FileOutput(genfilename()))
+
+registry = metrics.REGISTRY
+if args.record == "motion":
+    h264_output.add_metrics(registry)
+    registry.gauge("motion_level", "Fraction of the lores frame that changed", fn=lambda: detector.level)
+encode_time = registry.histogram("mjpeg_encode_seconds", "Time encoding a preview frame")
+
+# The preview is software encoded from a copy of the lores plane taken as
+# each request of the recording completes. With --adaptive at whatever
+# quality, rate and size the controller picks, with --simulcast at the lores
+# size and each halving of it that has viewers.
+if args.adaptive:
+    output = FrameBroadcast()
+    controller = adaptive.controller_from_args(args)
+    controller.add_metrics(registry)
+    stream = adaptive.AdaptiveStream(output, controller, config["lores"]["format"])
+    streams = {'/stream.mjpg': output}
+elif args.simulcast:
+    stream = simulcast.Simulcast(config["lores"]["format"], config["lores"]["size"], args.simulcast, args.simulcastquality, minwidth=80)
+    streams = stream.streams('/stream.mjpg')
+else:
+    stream = simulcast.Simulcast(config["lores"]["format"], config["lores"]["size"], 0, args.previewquality)
+    streams = {'/stream.mjpg': stream.outputs()[0]}
+
+for path, s in streams.items():
+    if not callable(s):
+        registry.add_stream(path, s)
+if args.metricslog:
+    registry.start_logging(args.metricslog)
+
+def preview(array):
+    t0 = time.perf_counter()
+    stream.secure(array)
+    stream.encode()
+    encode_time.observe(time.perf_counter() - t0)
+
+def motionwatch(array):
+    if detector.update(framesource.yuv420_planes(array)[0]):
+        if not h264_output.recording():
+            print("Motion %.3f, recording" % detector.level)
+        h264_output.trigger()
+
+tap = frametap.FrameTap(MappedArray, "lores")
+tap.add_metrics(registry)
+tap.add(preview, args.previewfps, stream.wanted)
+if args.record == "motion":
+    tap.add(motionwatch, args.motionfps)
+picam2.post_callback = tap
 
 picam2.start_recording(h264_encoder, h264_output)
 
-def mjpegpush():
-    while True:
-        print("frame")
-        request = picam2.capture_request()
-        mjpeg_encoder.encode("lores", request)
-        request.release()
-        time.sleep(1)
-
-
 try:
     threading.Thread(target=start_server).start()
-    threading.Thread(target=mjpegpush).start()
 
     while True:
         time.sleep(60)
-        h264_output.split_output(FileOutput(genfilename()))
+        if args.record == "continuous":
+            h264_output.split_output(FileOutput(genfilename()))
 	
 finally:
     picam2.stop_recording()
 
-
-
-mjpeg_encoder.stop()
-picam2.stop_recording()